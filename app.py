@@ -1,10 +1,42 @@
+import functools
+import queue
 import sqlite3
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, stream_with_context
 from datetime import datetime
 import json
+import orjson
+# 消息角色位编码与“仅工具调用”判定与导出脚本共用
+from utils import FROM_CODES, FROM_TOOL, mask_function_call_only, migrate_conversation_storage
 
 app = Flask(__name__)
 
+# 每个连接都要设置的 PRAGMA；journal_mode=WAL 持久化在库文件中，建表时设置一次即可
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-65536',      # 64MB 页缓存
+    'PRAGMA mmap_size=268435456',    # 256MB 内存映射
+)
+
+# _pretty_or_raw 进入缓存的文本长度上限（按字符计）
+PRETTY_CACHE_MAX_TEXT = 64 * 1024
+_ALREADY_PRETTY_PREFIXES = ('{\n  ', '[\n  ')
+
+# 请求路径上使用的 SQL，固定文本便于命中连接的预编译语句缓存
+_SQL_GET_INTERACTIONS = 'SELECT id, model, conversation, timestamp FROM interactions ORDER BY timestamp DESC'
+_SQL_GET_CONFIRMED = 'SELECT id, model, conversation, original_timestamp, confirmed_timestamp FROM confirmed_interactions ORDER BY confirmed_timestamp DESC'
+_SQL_DELETE = 'DELETE FROM interactions WHERE id = ?'
+_SQL_CONFIRM_INSERT = '''
+    INSERT OR REPLACE INTO confirmed_interactions (id, model, conversation, original_timestamp)
+    SELECT id, model, conversation, timestamp FROM interactions WHERE id = ?
+'''
+# 连接级预编译语句缓存容量（sqlite3 默认 128）
+DB_CACHED_STATEMENTS = 256
+
+# 连接池：复用已打开并设置好 PRAGMA 的连接，避免每个请求都 open/close 数据库文件
+DB_POOL_SIZE = 8
+_db_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=DB_POOL_SIZE)
+
 def ensure_confirmed_table():
     conn = get_db_connection()
     try:
@@ -18,14 +50,18 @@ def ensure_confirmed_table():
                 confirmed_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        # 列表按确认时间倒序展示
+        c.execute('CREATE INDEX IF NOT EXISTS idx_confirmed_ts ON confirmed_interactions(confirmed_timestamp)')
         conn.commit()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 def ensure_interactions_table():
     conn = get_db_connection()
     try:
         c = conn.cursor()
+        # WAL：读写互不阻塞（与代理进程并发写入时尤其明显）
+        c.execute('PRAGMA journal_mode=WAL')
         c.execute('''
             CREATE TABLE IF NOT EXISTS interactions (
                 id TEXT PRIMARY KEY,
@@ -34,94 +70,210 @@ def ensure_interactions_table():
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+        # 列表与导出均按时间排序
+        c.execute('CREATE INDEX IF NOT EXISTS idx_interactions_timestamp ON interactions(timestamp)')
         conn.commit()
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 
 
 def get_db_connection():
-    conn = sqlite3.connect('interactions.db')
+    """从连接池取连接，池空时新建；用完需调用 release_db_connection 归还"""
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        pass
+    # Flask 开发服务器每个请求一个线程，池中连接会跨线程复用
+    conn = sqlite3.connect('interactions.db', check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+def release_db_connection(conn):
+    """归还连接到池中；池满则直接关闭"""
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        _db_pool.put_nowait(conn)
+    except (queue.Full, sqlite3.Error):
+        conn.close()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
-@app.route('/get_interactions')
-def get_interactions():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # 获取所有记录
-    cursor.execute('SELECT id, model, conversation, timestamp FROM interactions')
-    rows = cursor.fetchall()
-    
-    def _pretty_or_raw(text: str, indent: int = 2, max_len: int = 8000) -> str:
-        """仅用于展示的美化：能解析JSON则缩进显示，过长添加截断提示"""
+def _prettify(text: str, indent: int = 2, max_len: int = 8000) -> str:
+    """仅用于展示的美化：能解析JSON则缩进显示，过长添加截断提示"""
+    # 已是缩进格式的 JSON 无需再解析一遍
+    if text.startswith(_ALREADY_PRETTY_PREFIXES):
+        pretty = text
+    else:
         try:
             obj = json.loads(text)
             pretty = json.dumps(obj, ensure_ascii=False, indent=indent)
         except Exception:
             pretty = text
-        if isinstance(pretty, str) and len(pretty) > max_len:
-            return pretty[:max_len] + "\n... truncated for display ..."
-        return pretty
+    if isinstance(pretty, str) and len(pretty) > max_len:
+        return pretty[:max_len] + "\n... truncated for display ..."
+    return pretty
+
+# 相同的工具返回经常在多条记录中重复出现，缓存美化结果
+_prettify_cached = functools.lru_cache(maxsize=4096)(_prettify)
+
+def _pretty_or_raw(text: str, indent: int = 2, max_len: int = 8000) -> str:
+    # 超长文本不进缓存，限制缓存内存占用
+    if len(text) < PRETTY_CACHE_MAX_TEXT:
+        return _prettify_cached(text, indent, max_len)
+    return _prettify(text, indent, max_len)
+
+def _parse_conversation(raw):
+    """
+    解析 conversation 列，返回 (对象, 可作为 orjson.Fragment 原样输出的原文或 None)。
+    orjson 拒绝而标准库接受的内容（NaN/Infinity 字面量、孤立代理项）回退 json.loads，此时原文不能直接嵌入响应。
+    """
+    try:
+        return orjson.loads(raw), raw
+    except orjson.JSONDecodeError:
+        if not isinstance(raw, (str, bytes)):
+            raise
+        return json.loads(raw), None
+
+def _dump_item(item):
+    """序列化一条列表记录；orjson 无法编码（如孤立代理项）时回退标准库 json（ASCII 转义），仍失败返回 None"""
+    try:
+        return orjson.dumps(item)
+    except orjson.JSONEncodeError:
+        pass
+    try:
+        return json.dumps(item, allow_nan=False).encode()
+    except (TypeError, ValueError):
+        return None
+
+def stream_data_response(conn, cursor, build_item):
+    """
+    以 {"data": [...]} 结构逐行流式输出，游标逐条消费，结束后关闭连接。
+    请求带 ?format=ndjson 时改为每行一条记录的 NDJSON 输出。
+    """
+    ndjson = request.args.get('format') == 'ndjson'
+
+    def generate_array():
+        yield b'{"data":['
+        sep = b''
+        for row in cursor:
+            item = build_item(row)
+            data = None if item is None else _dump_item(item)
+            if data is None:
+                continue
+            yield sep + data
+            sep = b','
+        yield b']}'
+
+    def generate_ndjson():
+        for row in cursor:
+            item = build_item(row)
+            data = None if item is None else _dump_item(item)
+            if data is not None:
+                yield data + b'\n'
+
+    released = False
+
+    def close():
+        # 生成器结束与响应关闭都会调用，只归还一次
+        nonlocal released
+        if released:
+            return
+        released = True
+        # 提前断开时游标可能未读完，先关闭以释放读快照再归还连接
+        cursor.close()
+        release_db_connection(conn)
 
+    def generate():
+        try:
+            yield from (generate_ndjson() if ndjson else generate_array())
+        finally:
+            close()
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    # 响应在开始迭代前就被关闭时生成器的 finally 不会执行，由此兜底归还连接
+    response.call_on_close(close)
+    return response
+
+def stream_query_response(sql, build_item):
+    """
+    从连接池取连接并执行查询，成功后交给 stream_data_response 流式输出并由其归还连接；
+    执行失败（如表尚不存在）时立即归还连接，避免耗尽固定大小的连接池。
+    """
+    conn = get_db_connection()
+    try:
+        cursor = conn.execute(sql)
+    except Exception as e:
+        release_db_connection(conn)
+        return jsonify({'error': str(e)}), 500
+    return stream_data_response(conn, cursor, build_item)
+
+@app.route('/get_interactions')
+def get_interactions():
     # 处理数据
-    data = []
-    for row in rows:
+    def _build_item(row):
+        # 响应已开始流式输出（状态码已发出），单条记录出错只能跳过，不能中断整个响应
+        try:
+            return _build_interaction_item(row)
+        except Exception:
+            return None
+
+    def _build_interaction_item(row):
         try:
             # 解析conversation JSON字符串
-            conversation = json.loads(row['conversation'])
-
-            # 构建仅用于展示的美化版，不修改原始数据
-            conversation_pretty = {
-                "conversations": [],
-                "system": conversation.get("system", ""),
-                "tools": conversation.get("tools", "[]")
-            }
-            preview = ''
-            conv_list = conversation.get('conversations', [])
-            # 计算是否为“仅工具调用”记录：存在 function_call，且不存在 gpt/assistant 文本项
-            function_call_only = False
-            if isinstance(conv_list, list):
-                has_function_call = any(isinstance(m, dict) and m.get('from') == 'function_call' for m in conv_list)
-                has_gpt_text = any(isinstance(m, dict) and m.get('from') in ('gpt', 'assistant') for m in conv_list)
-                function_call_only = bool(has_function_call and not has_gpt_text)
-
-                for msg in conv_list:
-                    pretty_msg = dict(msg)
-                    # 仅对 function_call/observation 的 value 做 JSON 美化尝试
-                    if msg.get('from') in ('function_call', 'observation'):
-                        val = msg.get('value', '')
-                        if isinstance(val, str):
-                            pretty_msg['value'] = _pretty_or_raw(val)
-                        else:
-                            pretty_msg['value'] = _pretty_or_raw(str(val))
-                    conversation_pretty['conversations'].append(pretty_msg)
-
-                    # 预览使用美化后的简短文本
-                    pv = pretty_msg.get('value', '')
-                    if not isinstance(pv, str):
-                        pv = str(pv)
-                    preview += f"{pretty_msg.get('from')}: {pv[:50]}...\n"
-            
-            data.append({
-                'id': row['id'],
-                'model': row['model'],
-                'conversation': preview,                       # 简短预览（已美化）
-                'full_conversation': conversation,             # 原始数据（训练/导出）
-                'full_conversation_pretty': conversation_pretty,  # 展示用数据
-                'function_call_only': function_call_only,       # 新增：仅工具调用标记
-                'timestamp': row['timestamp']
-            })
-        except json.JSONDecodeError:
-            continue
-    
-    conn.close()
-    return jsonify({'data': data})
+            conversation, raw = _parse_conversation(row['conversation'])
+        except ValueError:
+            return None
+        if type(conversation) is not dict:
+            return None
+
+        preview_parts = []
+        conv_list = conversation.get('conversations', [])
+        # 计算是否为“仅工具调用”记录：存在 function_call，且不存在 gpt/assistant 文本项
+        function_call_only = False
+        if isinstance(conv_list, list):
+            mask = 0
+
+            # 循环内用到的方法/函数先绑定为局部变量
+            append_preview = preview_parts.append
+            pretty_fn = _pretty_or_raw
+            codes_get = FROM_CODES.get
+            # 单次遍历：同时累积角色标记与预览
+            for msg in conv_list:
+                if type(msg) is not dict:
+                    continue
+                frm = msg.get('from')
+                code = codes_get(frm, 0) if type(frm) is str else 0
+                mask |= code
+                val = msg.get('value', '')
+                # 仅对 function_call/observation 的 value 做 JSON 美化尝试（详情页的完整美化由前端按需完成）
+                if code & FROM_TOOL:
+                    val = pretty_fn(val if isinstance(val, str) else str(val))
+
+                # 预览使用美化后的简短文本
+                if not isinstance(val, str):
+                    val = str(val)
+                append_preview(f"{frm}: {val[:50]}...\n")
+
+            function_call_only = mask_function_call_only(mask)
+
+        return {
+            'id': row['id'],
+            'model': row['model'],
+            'conversation': ''.join(preview_parts),        # 简短预览（已美化）
+            # 原始数据（训练/导出）：原文直接写入响应不再重新序列化；标准库兜底解析的记录改为输出解析结果
+            'full_conversation': orjson.Fragment(raw) if raw is not None else conversation,
+            'function_call_only': function_call_only,       # 新增：仅工具调用标记
+            'timestamp': row['timestamp']
+        }
+
+    # 获取所有记录（不 fetchall，逐行迭代游标；按时间倒序与页面默认排序一致，可走索引）
+    return stream_query_response(_SQL_GET_INTERACTIONS, _build_item)
 
 @app.route('/delete', methods=['POST'])
 def delete_interaction():
@@ -133,51 +285,64 @@ def delete_interaction():
     
     conn = get_db_connection()
     try:
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM interactions WHERE id = ?', (interaction_id,))
+        conn.execute(_SQL_DELETE, (interaction_id,))
         conn.commit()
         return jsonify({'success': True})
     except Exception as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/get_confirmed')
 def get_confirmed():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    # 确保表存在（防止还未调用 confirm 前就查询）
-    ensure_confirmed_table()
-    cursor.execute('SELECT id, model, conversation, original_timestamp, confirmed_timestamp FROM confirmed_interactions ORDER BY confirmed_timestamp DESC')
-    rows = cursor.fetchall()
-    data = []
-    for row in rows:
+    def _build_item(row):
+        raw = row['conversation']
         try:
-            conv = json.loads(row['conversation'])
+            conv, text = _parse_conversation(raw)
+            # 已校验为合法 JSON，输出时直接写入原文（标准库兜底解析的记录输出解析结果）
+            full_conversation = orjson.Fragment(text) if text is not None else conv
         except Exception:
-            conv = row['conversation']
+            # 无法解析时原样展示
+            conv = full_conversation = raw
 
         # 计算 confirmed 记录是否为“仅工具调用”
         function_call_only = False
         try:
             conv_list = conv.get('conversations', []) if isinstance(conv, dict) else []
-            has_function_call = any(isinstance(m, dict) and m.get('from') == 'function_call' for m in conv_list)
-            has_gpt_text = any(isinstance(m, dict) and m.get('from') in ('gpt', 'assistant') for m in conv_list)
-            function_call_only = bool(has_function_call and not has_gpt_text)
+            mask = 0
+            for m in conv_list:
+                if not isinstance(m, dict):
+                    continue
+                frm = m.get('from')
+                if type(frm) is str:
+                    mask |= FROM_CODES.get(frm, 0)
+            function_call_only = mask_function_call_only(mask)
         except Exception:
             function_call_only = False
 
-        data.append({
+        return {
             'id': row['id'],
             'model': row['model'],
-            'full_conversation': conv,
+            'full_conversation': full_conversation,
             'function_call_only': function_call_only,
             'original_timestamp': row['original_timestamp'],
             'confirmed_timestamp': row['confirmed_timestamp']
-        })
-    conn.close()
-    return jsonify({'data': data})
+        }
+
+    # 表结构由 _init_tables 在模块加载时创建
+    return stream_query_response(_SQL_GET_CONFIRMED, _build_item)
+
+def _confirm_ids(conn, ids) -> int:
+    """单事务内把一批记录复制到 confirmed 表并从原表删除，返回确认条数"""
+    params = [(i,) for i in ids]
+    with conn:
+        # 直接 INSERT ... SELECT，记录不必往返 Python；重复确认时覆盖旧记录
+        cursor = conn.executemany(_SQL_CONFIRM_INSERT, params)
+        confirmed = cursor.rowcount
+        # 从原表删除
+        conn.executemany(_SQL_DELETE, params)
+    return confirmed
 
 @app.route('/confirm', methods=['POST'])
 def confirm_interaction():
@@ -189,44 +354,42 @@ def confirm_interaction():
     
     conn = get_db_connection()
     try:
-        # 获取要确认的记录
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM interactions WHERE id = ?', (interaction_id,))
-        record = cursor.fetchone()
-        
-        if record:
-            # 创建confirmed_interactions表（如果不存在）
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS confirmed_interactions (
-                    id TEXT PRIMARY KEY,
-                    model TEXT,
-                    conversation TEXT,
-                    original_timestamp DATETIME,
-                    confirmed_timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # 插入到confirmed_interactions表
-            cursor.execute('''
-                INSERT INTO confirmed_interactions (id, model, conversation, original_timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (record['id'], record['model'], record['conversation'], record['timestamp']))
-            
-            # 从原表删除
-            cursor.execute('DELETE FROM interactions WHERE id = ?', (interaction_id,))
-            
-            conn.commit()
-            return jsonify({'success': True})
-        else:
+        # 表结构由 _init_tables 在模块加载时创建
+        if _confirm_ids(conn, [interaction_id]) == 0:
             return jsonify({'error': '记录不存在'}), 404
+        return jsonify({'success': True})
     except Exception as e:
-        conn.rollback()
         return jsonify({'error': str(e)}), 500
     finally:
-        conn.close()
+        release_db_connection(conn)
 
-if __name__ == '__main__':
-    # 启动前确保表存在
+@app.route('/confirm_bulk', methods=['POST'])
+def confirm_bulk():
+    data = request.get_json()
+    ids = data.get('ids')
+
+    if not ids or not isinstance(ids, list):
+        return jsonify({'error': '未提供ID列表'}), 400
+
+    conn = get_db_connection()
+    try:
+        # 一个事务、一次提交完成整批确认
+        confirmed = _confirm_ids(conn, ids)
+        return jsonify({'success': True, 'confirmed': confirmed})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        release_db_connection(conn)
+
+def _init_tables():
+    """启动时建表/建索引（仅执行一次，请求处理路径不再重复检查表结构）"""
     ensure_interactions_table()
     ensure_confirmed_table()
+    # 旧库中残留的压缩记录转为明文 JSON
+    migrate_conversation_storage('interactions.db')
+
+# 模块加载时建表一次（python app.py 与 flask run 均适用）
+_init_tables()
+
+if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
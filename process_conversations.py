@@ -1,48 +1,99 @@
 import sqlite3
+# 解析统一用 orjson；嵌入为字符串的 JSON（tools/arguments）仍用 json.dumps，保持与代理写入的格式一致
 import json
+import orjson
 import os
 import argparse
+import hashlib
 import uuid
-from typing import Dict, Any, List, Tuple, cast
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+from itertools import chain, islice
+from typing import Dict, Any, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from utils import FROM_CODES, FROM_FUNCTION_CALL, FROM_GPT, FROM_TOOL, mask_function_call_only, migrate_conversation_storage
+
+# 导出文件写缓冲大小
+WRITE_BUFFER_SIZE = 1 << 20
+# 每累积多少行调用一次 writelines
+WRITE_BATCH_LINES = 1024
 
 def convert_tools_to_string(obj):
-    """递归将 'tools' 字段（若为列表）转换为 JSON 字符串。"""
-    if isinstance(obj, dict):
-        for k, v in obj.items():
-            if k == "tools" and isinstance(v, list):
-                obj[k] = json.dumps(v, ensure_ascii=False)
-            else:
-                convert_tools_to_string(v)
-    elif isinstance(obj, list):
-        for it in obj:
-            convert_tools_to_string(it)
+    """将任意层级的 'tools' 字段（若为列表）转换为 JSON 字符串；显式栈遍历，避免递归开销与深度限制。"""
+    _stringify_tools_inplace(obj)
     return obj
 
-def validate_sharegpt(data: Dict[str, Any]) -> None:
-    """验证 ShareGPT 扩展结构（包含 function_call/observation）。有问题直接抛异常。"""
+def _stringify_tools_inplace(obj) -> bool:
+    """convert_tools_to_string 的实现，返回是否有字段被转换"""
+    converted = False
+    stack = [obj]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        x = pop()
+        # orjson 解析结果只含原生 dict/list，type() 判断比 isinstance 更快
+        if type(x) is dict:
+            for k, v in x.items():
+                tv = type(v)
+                if tv is list:
+                    if k == "tools":
+                        x[k] = json.dumps(v, ensure_ascii=False)
+                        converted = True
+                    else:
+                        push(v)
+                elif tv is dict:
+                    push(v)
+        elif type(x) is list:
+            for v in x:
+                tv = type(v)
+                if tv is dict or tv is list:
+                    push(v)
+    return converted
+
+def validate_sharegpt(data: Dict[str, Any], tools_serialized: bool = False) -> Tuple[bool, bool, bool]:
+    """
+    验证 ShareGPT 扩展结构（包含 function_call/observation）。有问题直接抛异常。
+    校验 conversations 的同一次遍历中顺带统计，返回 (has_tool_use, has_gpt_text, function_call_only)，
+    语义与 has_tool_use / is_function_call_only 一致。
+    tools_serialized=True 表示 tools 字符串刚由本地 json.dumps 生成，跳过 JSON 合法性复检。
+    """
     if not isinstance(data, dict):
         raise ValueError("根对象不是字典")
-    if "conversations" not in data or not isinstance(data["conversations"], list):
+    convs = data.get("conversations")
+    if not isinstance(convs, list):
         raise ValueError("缺少或错误的 conversations")
-    for conv in data["conversations"]:
+    # 角色按位编码：mask 累积出现过的角色，last_code 记录最后一个已知角色
+    codes_get = FROM_CODES.get
+    mask = 0
+    last_code = 0
+    for conv in convs:
         if not isinstance(conv, dict):
             raise ValueError("conversation 条目不是对象")
         if "from" not in conv or "value" not in conv:
             raise ValueError("conversation 条目缺少 from/value")
-    if "system" not in data or not isinstance(data["system"], str):
+        role = conv["from"]
+        code = codes_get(role, 0) if type(role) is str else 0
+        if code:
+            mask |= code
+            last_code = code
+    if not isinstance(data.get("system"), str):
         raise ValueError("缺少或错误的 system 字段")
     if "tools" not in data:
         raise ValueError("缺少 tools 字段")
     # tools 可为字符串或列表
-    if isinstance(data["tools"], list):
-        data["tools"] = json.dumps(data["tools"], ensure_ascii=False)
-    elif not isinstance(data["tools"], str):
+    tools = data["tools"]
+    if isinstance(tools, list):
+        data["tools"] = json.dumps(tools, ensure_ascii=False)
+    elif not isinstance(tools, str):
         raise ValueError("tools 必须是字符串或列表")
-    # 校验 tools 字符串是合法 JSON
-    try:
-        json.loads(data["tools"])
-    except Exception:
-        raise ValueError("tools 字符串不是有效 JSON")
+    elif not tools_serialized and tools != "[]":
+        # 校验 tools 字符串是合法 JSON（代理对无工具请求写入的 "[]" 无需解析）
+        try:
+            _loads_lenient(tools)
+        except Exception:
+            raise ValueError("tools 字符串不是有效 JSON")
+    return bool(mask & FROM_TOOL), bool(mask & FROM_GPT), last_code == FROM_FUNCTION_CALL
 
 def sharegpt_to_openai_messages(conv_list: List[Dict[str, Any]], system_text: str = "") -> List[Dict[str, Any]]:
     """
@@ -63,7 +114,7 @@ def sharegpt_to_openai_messages(conv_list: List[Dict[str, Any]], system_text: st
         tc = value
         if isinstance(value, str):
             try:
-                tc = json.loads(value)
+                tc = orjson.loads(value)
             except Exception:
                 # 兜底：作为未知函数名、原串作为参数
                 return {
@@ -84,7 +135,8 @@ def sharegpt_to_openai_messages(conv_list: List[Dict[str, Any]], system_text: st
         tool_id = tc.get("id") or f"toolcall_{idx}"
         return {"id": tool_id, "type": "function", "function": {"name": name, "arguments": args}}
 
-    pending_tool_calls: List[Dict[str, Any]] = []
+    # 待配对的 tool_calls：observation 从队首取出配对，deque.popleft 为 O(1)
+    pending_tool_calls: deque = deque()
     orphan_counter = 0
     for i, item in enumerate(conv_list or []):
         if not isinstance(item, dict):
@@ -94,14 +146,14 @@ def sharegpt_to_openai_messages(conv_list: List[Dict[str, Any]], system_text: st
         if frm == "human":
             # flush pending tool_calls before new user turn
             if pending_tool_calls:
-                messages.append({"role": "assistant", "content": "", "tool_calls": pending_tool_calls})
-                pending_tool_calls = []
+                messages.append({"role": "assistant", "content": "", "tool_calls": list(pending_tool_calls)})
+                pending_tool_calls.clear()
             messages.append({"role": "user", "content": val if isinstance(val, str) else str(val)})
         elif frm in ("gpt", "assistant"):
             # flush pending tool_calls first
             if pending_tool_calls:
-                messages.append({"role": "assistant", "content": "", "tool_calls": pending_tool_calls})
-                pending_tool_calls = []
+                messages.append({"role": "assistant", "content": "", "tool_calls": list(pending_tool_calls)})
+                pending_tool_calls.clear()
             if isinstance(val, str) and val.strip():
                 messages.append({"role": "assistant", "content": val})
         elif frm == "function_call":
@@ -111,7 +163,7 @@ def sharegpt_to_openai_messages(conv_list: List[Dict[str, Any]], system_text: st
             tool_content = val if isinstance(val, str) else str(val)
             if pending_tool_calls:
                 # pair with the earliest unpaired
-                tc = pending_tool_calls.pop(0)
+                tc = pending_tool_calls.popleft()
                 # ensure assistant tool_calls emitted before tool response
                 messages.append({"role": "assistant", "content": "", "tool_calls": [tc]})
                 messages.append({"role": "tool", "tool_call_id": tc["id"], "content": tool_content})
@@ -128,28 +180,33 @@ def sharegpt_to_openai_messages(conv_list: List[Dict[str, Any]], system_text: st
 
     # flush trailing pending tool_calls
     if pending_tool_calls:
-        messages.append({"role": "assistant", "content": "", "tool_calls": pending_tool_calls})
+        messages.append({"role": "assistant", "content": "", "tool_calls": list(pending_tool_calls)})
 
     return messages
 
 def _safe_json_loads(s: str):
     try:
-        return json.loads(s)
+        return orjson.loads(s)
     except Exception:
         return None
 
+@lru_cache(maxsize=256)
+def _parse_baked_tools(tools_raw: str) -> Tuple[Any, ...]:
+    """解析 tools 字符串为工具列表（非列表视为空）。同一数据库中 tools 大多重复，按原串缓存解析结果"""
+    parsed = _safe_json_loads(tools_raw)
+    return tuple(parsed) if isinstance(parsed, list) else ()
+
+# JSON 解析结果只含这几种原生类型，按 type() 直接查表（bool 有独立键，不会落到 int）
+_JSON_TYPE_NAMES = {
+    bool: "boolean",
+    int: "integer",
+    float: "number",
+    dict: "object",
+    list: "array",
+}
+
 def _guess_json_type(v):
-    if isinstance(v, bool):
-        return "boolean"
-    if isinstance(v, int):
-        return "integer"
-    if isinstance(v, float):
-        return "number"
-    if isinstance(v, dict):
-        return "object"
-    if isinstance(v, list):
-        return "array"
-    return "string"
+    return _JSON_TYPE_NAMES.get(type(v), "string")
 
 def derive_tools_schema(conv_list: List[Dict[str, Any]], tools_schema_mode: str, tools_raw: Any) -> List[Dict[str, Any]]:
     """
@@ -162,9 +219,8 @@ def derive_tools_schema(conv_list: List[Dict[str, Any]], tools_schema_mode: str,
     mode = (tools_schema_mode or "auto").lower()
     baked_tools = []
     if isinstance(tools_raw, str) and tools_raw.strip():
-        parsed = _safe_json_loads(tools_raw)
-        if isinstance(parsed, list):
-            baked_tools = parsed
+        # 缓存中的工具对象在多条记录间共享，仅复制外层列表
+        baked_tools = list(_parse_baked_tools(tools_raw))
 
     if mode == "no":
         return []
@@ -228,54 +284,196 @@ def derive_tools_schema(conv_list: List[Dict[str, Any]], tools_schema_mode: str,
 
 def is_function_call_only(conv_list: List[Dict[str, Any]]) -> bool:
     """
-    按“最后一轮”判断 fc-only：
-    - 在 conversations 顺序中，找到最后一个 from 属于 {human/gpt/function_call/observation} 的条目
-    - 若最后一个为 function_call（其后没有 gpt 文本），则视为 fc-only
-    注意：历史中出现过 gpt 文本不影响该轮是否为 fc-only
+    按“最后一轮”判断 fc-only：最后一个已知角色（见 FROM_CODES）为 function_call 即视为 fc-only，
+    历史中出现过 gpt 文本不影响。保留给外部调用方；导出流程由 validate_sharegpt 在校验遍历中顺带得出。
     """
-    if not isinstance(conv_list, list) or not conv_list:
+    if not isinstance(conv_list, list):
         return False
-    last_role = None
+    codes_get = FROM_CODES.get
+    last_code = 0
     for item in conv_list:
         if not isinstance(item, dict):
             continue
         role = item.get("from")
-        if role in ("human", "gpt", "function_call", "observation", "assistant"):
-            last_role = role
-    return last_role == "function_call"
+        code = codes_get(role, 0) if type(role) is str else 0
+        if code:
+            last_code = code
+    # 仅由最后一个角色构成的掩码：含 function_call 且无 gpt 文本
+    return mask_function_call_only(last_code)
 
 def has_tool_use(conv_list: List[Dict[str, Any]]) -> bool:
     return any(isinstance(m, dict) and m.get("from") in ("function_call", "observation") for m in conv_list)
 
-def truncate_observation_inplace(data: Dict[str, Any], max_len: int) -> None:
-    """对 observation 的 value 进行长度截断（仅导出时生效，不改数据库）。"""
+# observation 截断后追加的提示
+_TRUNC_SUFFIX = "\n... [truncated at export] ..."
+
+def truncate_observation_inplace(data: Dict[str, Any], max_len: int) -> bool:
+    """对 observation 的 value 进行长度截断（仅导出时生效，不改数据库）。返回是否有内容被截断。"""
     if max_len <= 0:
-        return
+        return False
     convs = data.get("conversations", [])
-    if not isinstance(convs, list):
-        return
+    if type(convs) is not list:
+        return False
+    truncated = False
     for m in convs:
-        if isinstance(m, dict) and m.get("from") == "observation":
+        if type(m) is dict and m.get("from") == "observation":
             v = m.get("value")
-            if isinstance(v, str) and len(v) > max_len:
-                m["value"] = v[:max_len] + "\n... [truncated at export] ..."
-
-def fetch_rows(conn: sqlite3.Connection, table: str, model_filter: str = "") -> List[Tuple[str, str]]:
-    """从指定表获取 conversation 列内容。"""
-    cur = conn.cursor()
-    if table == "confirmed_interactions":
-        base_sql = "SELECT model, conversation FROM confirmed_interactions ORDER BY confirmed_timestamp"
-    else:
-        base_sql = "SELECT model, conversation FROM interactions ORDER BY timestamp"
+            if type(v) is str and len(v) > max_len:
+                m["value"] = v[:max_len] + _TRUNC_SUFFIX
+                truncated = True
+    return truncated
+
+def fetch_rows(conn: sqlite3.Connection, table: str, model_filter: str = "") -> Iterator[Tuple[Optional[str], Union[str, bytes]]]:
+    """从指定表逐行读取 (model, conversation)；模型名包含匹配在 SQL 中完成。"""
+    order_col = "confirmed_timestamp" if table == "confirmed_interactions" else "timestamp"
+    sql = f"SELECT model, conversation FROM {table}"
+    params: Tuple[str, ...] = ()
     if model_filter:
-        cur.execute(base_sql)
-        all_rows = cur.fetchall()
-        # 规范化为字符串元组，避免 None 触发类型告警
-        norm_rows: List[Tuple[str, str]] = [(str(m or ""), str(c or "")) for (m, c) in all_rows]
-        return [rc for rc in norm_rows if model_filter in rc[0]]
-    cur.execute(base_sql)
-    # 显式收敛类型
-    return cast(List[Tuple[str, str]], [(str(m or ""), str(c or "")) for (m, c) in cur.fetchall()])
+        # instr 保持与 Python `in` 一致的大小写敏感子串语义（LIKE 不区分大小写且会解释 %/_）
+        sql += " WHERE instr(model, ?) > 0"
+        params = (model_filter,)
+    sql += f" ORDER BY {order_col}"
+    # 逐行迭代游标，不再 fetchall 整表；model 仅透传不做转换，conversation 仅把 NULL 等非文本值规范化为字符串
+    for m, c in conn.execute(sql, params):
+        yield (m, c if type(c) is str else str(c or ""))
+
+def dedup_rows(rows: Iterator[Tuple[Optional[str], Union[str, bytes]]], stats: Dict[str, int]) -> Iterator[Tuple[Optional[str], Union[str, bytes]]]:
+    """按 conversation 原文去重（128 位摘要），重复记录不再进入解析流程，计数写入 stats["duplicates"]。"""
+    seen = set()
+    for model, conv in rows:
+        key = hashlib.blake2b(conv if type(conv) is bytes else conv.encode("utf-8"), digest_size=16).digest()
+        if key in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(key)
+        yield model, conv
+
+class ExportOptions(NamedTuple):
+    """逐条处理所需的导出参数（需可 pickle，供子进程使用）"""
+    only_function_call_only: bool = False
+    truncate_observation: int = 0
+    out_format: str = "sharegpt"
+    tools_schema_mode: str = "auto"
+    fast_passthrough: bool = False
+
+# process_row 的处理结果
+ROW_OK = 0      # 有效样本，附带待写出的 JSONL 行
+ROW_SKIP = 1    # 被 only_function_call_only 过滤
+ROW_BAD = 2     # 无效样本，附带错误描述
+ROW_PROBED = 3  # 被 only_function_call_only 预筛跳过（未解析，不参与校验与统计）
+
+# only_function_call_only 预筛用的原文子串
+_FC_PROBE_TEXT = '"function_call"'
+_FC_PROBE_BYTES = _FC_PROBE_TEXT.encode("utf-8")
+
+# 并行时每次从游标取出并分发的行数，以及进程池单次 IPC 的任务数
+PARALLEL_CHUNK_ROWS = 10_000
+PARALLEL_MAP_CHUNKSIZE = 500
+
+def _loads_lenient(s: Union[str, bytes]) -> Tuple[Any, bool]:
+    """
+    解析 JSON，返回 (对象, 是否由 orjson 严格解析)。
+    orjson 拒绝而标准库接受的内容（NaN/Infinity 字面量、孤立代理项）回退 json.loads，不因换用 orjson 而判为无效。
+    """
+    try:
+        return orjson.loads(s), True
+    except orjson.JSONDecodeError:
+        return json.loads(s), False
+
+def _dumps_line(obj: Any) -> bytes:
+    """序列化为一行 JSONL；orjson 无法编码的内容（孤立代理项等）回退标准库 json（ASCII 转义）"""
+    try:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj).encode("utf-8") + b"\n"
+
+def process_row(conv_str: Union[str, bytes], opts: ExportOptions) -> Tuple[int, Any, bool, bool, bool]:
+    """
+    处理单条记录：解析 → 校验 → 截断/转换 → 序列化。不依赖外部状态，可在子进程中执行。
+    返回 (状态, JSONL 行字节或错误描述, has_tool_use, has_gpt_text, function_call_only)。
+    """
+    has_tool = has_gpt = fc_only = False
+    if opts.only_function_call_only:
+        # 预筛：原文中不含 "function_call" 的记录不可能是 fc-only，不解析直接跳过
+        probe = _FC_PROBE_BYTES if type(conv_str) is bytes else _FC_PROBE_TEXT
+        if probe not in conv_str:
+            return ROW_PROBED, None, has_tool, has_gpt, fc_only
+    try:
+        data, strict = _loads_lenient(conv_str)
+
+        # 统一 tools 字段为字符串（顶层 tools 若为列表，转换后无需再校验其 JSON 合法性）
+        tools_serialized = type(data) is dict and type(data.get("tools")) is list
+        modified = _stringify_tools_inplace(data)
+
+        # 校验结构，同时得到指标统计所需的标记
+        has_tool, has_gpt, fc_only = validate_sharegpt(data, tools_serialized)
+        conv_list = data["conversations"]
+
+        if opts.only_function_call_only and not fc_only:
+            # 过滤掉非 function_call-only
+            return ROW_SKIP, None, has_tool, has_gpt, fc_only
+
+        # 导出前对 observation 截断（不影响原数据）；无工具消息的记录不必遍历
+        if opts.truncate_observation > 0 and has_tool:
+            modified = truncate_observation_inplace(data, opts.truncate_observation) or modified
+
+        # 生成有效样本（支持两种格式）
+        if opts.out_format == "openai":
+            msgs = sharegpt_to_openai_messages(conv_list, data.get("system", ""))
+            out_obj = {"messages": msgs}
+            # 当且仅当存在函数调用时，按策略输出 tools。
+            # 含 function_call/observation 时转换结果必有 assistant tool_calls（孤立 observation 也会补一条），
+            # 直接复用校验时得到的 has_tool，无需再扫描 msgs
+            if has_tool:
+                tools_list = derive_tools_schema(conv_list, opts.tools_schema_mode, data.get("tools"))
+                if tools_list:
+                    out_obj["tools"] = tools_list
+            return ROW_OK, _dumps_line(out_obj), has_tool, has_gpt, fc_only
+        if opts.fast_passthrough and strict and not modified:
+            # 显式开启时：校验通过且未做任何改写的记录直接写出原文（需为单行），省去一次重新序列化；
+            # 原文保留库中的空白与键格式，与其余 orjson 紧凑输出的行不一致
+            raw = conv_str if type(conv_str) is bytes else conv_str.encode("utf-8")
+            if b"\n" not in raw and b"\r" not in raw:
+                return ROW_OK, raw + b"\n", has_tool, has_gpt, fc_only
+        return ROW_OK, _dumps_line(data), has_tool, has_gpt, fc_only
+    except Exception as e:
+        return ROW_BAD, repr(e), has_tool, has_gpt, fc_only
+
+def iter_processed(rows: Iterator[Tuple[Optional[str], Union[str, bytes]]], opts: ExportOptions, workers: int = 1) -> Iterator[Tuple[Union[str, bytes], Tuple[int, Any, bool, bool, bool]]]:
+    """
+    按原始顺序产出 (conv_str, process_row 结果)。
+    单进程时逐行读取、逐行处理；workers > 1 且数据量超过一个分块时，按块分发到进程池，始终保持下一块在途，读库与解析重叠。
+    调用方提前关闭生成器（如达到 max_records）时不再提交新块，并取消已排队但尚未开始的任务。
+    """
+    process = partial(process_row, opts=opts)
+    if workers <= 1:
+        for _model, conv_str in rows:
+            yield conv_str, process(conv_str)
+        return
+
+    first_chunk = list(islice(rows, PARALLEL_CHUNK_ROWS))
+    if len(first_chunk) < PARALLEL_CHUNK_ROWS:
+        # 数据量不足一块，不值得启动进程池
+        for _model, conv_str in first_chunk:
+            yield conv_str, process(conv_str)
+        return
+
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        in_flight: deque = deque()
+        chunk = first_chunk
+        while chunk:
+            conv_strs = [c for _m, c in chunk]
+            in_flight.append((conv_strs, executor.map(process, conv_strs, chunksize=PARALLEL_MAP_CHUNKSIZE)))
+            if len(in_flight) > 1:
+                done_strs, results = in_flight.popleft()
+                yield from zip(done_strs, results)
+            chunk = list(islice(rows, PARALLEL_CHUNK_ROWS))
+        while in_flight:
+            done_strs, results = in_flight.popleft()
+            yield from zip(done_strs, results)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
 
 def process_conversations(
     db_path: str = "interactions.db",
@@ -287,18 +485,33 @@ def process_conversations(
     model_filter: str = "",
     max_records: int = 0,
     out_format: str = "sharegpt",
-    tools_schema_mode: str = "auto"
+    tools_schema_mode: str = "auto",
+    workers: int = 1,
+    dedup: bool = False,
+    fast_passthrough: bool = False
 ) -> None:
-    """导出 + 校验：从数据库导出 ShareGPT 扩展格式 JSONL，并输出统计。"""
+    """
+    导出 + 校验：从数据库导出 ShareGPT 扩展格式 JSONL，并输出统计。workers > 1 时多进程并行解析。
+    dedup=True 时跳过内容完全相同的重复记录；fast_passthrough=True 时 sharegpt 格式下未改写的记录原文写出。
+    """
     conn = None
     if table not in ("interactions", "confirmed_interactions"):
         raise ValueError("table 必须为 interactions 或 confirmed_interactions")
 
     try:
+        # 导出前确保 conversation 列为明文（已迁移的库直接返回）
+        migrate_conversation_storage(db_path)
         conn = sqlite3.connect(db_path)
+        # 只读导出：放大页缓存与 mmap，临时排序放内存
+        for pragma in ("PRAGMA temp_store=MEMORY", "PRAGMA cache_size=-65536", "PRAGMA mmap_size=268435456"):
+            conn.execute(pragma)
         rows = fetch_rows(conn, table, model_filter)
+        dedup_stats = {"duplicates": 0}
+        if dedup:
+            rows = dedup_rows(rows, dedup_stats)
 
-        if not rows:
+        first_row = next(rows, None)
+        if first_row is None:
             print("❌ 没有匹配的数据")
             return
 
@@ -307,67 +520,67 @@ def process_conversations(
         fc_only_count = 0
         with_tool_count = 0
         with_gpt_count = 0
+        probe_skipped_count = 0
         errors: List[str] = []
         total = 0
 
-        with open(output_file, "w", encoding="utf-8") as f_ok, open(invalid_file, "w", encoding="utf-8") as f_bad:
-            for idx, (model, conv_str) in enumerate(rows, 1):
-                if max_records and valid_count + invalid_count >= max_records:
-                    break
-                total += 1
-                try:
-                    data = json.loads(conv_str)
-
-                    # 统一 tools 字段为字符串
-                    convert_tools_to_string(data)
-
-                    # 校验结构
-                    validate_sharegpt(data)
+        # 以二进制写出：orjson 直接产出 UTF-8 字节，省去 str -> bytes 编码；1MB 缓冲合并小块写入
+        with open(output_file, "wb", buffering=WRITE_BUFFER_SIZE) as f_ok, \
+                open(invalid_file, "wb", buffering=WRITE_BUFFER_SIZE) as f_bad:
+            opts = ExportOptions(only_function_call_only, truncate_observation, out_format, tools_schema_mode, fast_passthrough)
+            processed = iter_processed(chain((first_row,), rows), opts, workers)
+            # 输出行先攒批，再整批 writelines，减少逐行 write 调用
+            ok_buf: List[bytes] = []
+            bad_buf: List[bytes] = []
+            try:
+                for idx, (conv_str, (status, payload, has_tool, has_gpt, fc_only)) in enumerate(processed, 1):
+                    total += 1
+                    if status == ROW_PROBED:
+                        # 预筛跳过的记录未经解析，不知其是否有效，单独计数
+                        probe_skipped_count += 1
+                        continue
 
-                    # 指标统计
-                    conv_list = data.get("conversations", [])
-                    if has_tool_use(conv_list):
+                    # 指标统计（与逐行处理时一致：过滤掉的记录也计入工具/助手文本统计）
+                    if has_tool:
                         with_tool_count += 1
-                    if any(isinstance(m, dict) and m.get("from") in ("gpt", "assistant") for m in conv_list):
+                    if has_gpt:
                         with_gpt_count += 1
-
-                    fc_only = is_function_call_only(conv_list)
-                    if only_function_call_only and not fc_only:
-                        # 过滤掉非 function_call-only
+                    if status == ROW_SKIP:
                         continue
                     if fc_only:
                         fc_only_count += 1
 
-                    # 导出前对 observation 截断（不影响原数据）
-                    if truncate_observation > 0:
-                        truncate_observation_inplace(data, truncate_observation)
-
-                    # 写入有效样本（支持两种格式）
-                    if out_format == "openai":
-                        msgs = sharegpt_to_openai_messages(conv_list, data.get("system", ""))
-                        out_obj = {"messages": msgs}
-                        # 当且仅当存在函数调用时，按策略输出 tools
-                        has_tool_calls = any(isinstance(m, dict) and m.get("role") == "assistant" and m.get("tool_calls") for m in msgs)
-                        if has_tool_calls:
-                            tools_list = derive_tools_schema(conv_list, tools_schema_mode, data.get("tools"))
-                            if tools_list:
-                                out_obj["tools"] = tools_list
-
-                        f_ok.write(json.dumps(out_obj, ensure_ascii=False) + "\n")
+                    if status == ROW_OK:
+                        ok_buf.append(payload)
+                        valid_count += 1
+                        if len(ok_buf) >= WRITE_BATCH_LINES:
+                            f_ok.writelines(ok_buf)
+                            ok_buf.clear()
                     else:
-                        f_ok.write(json.dumps(data, ensure_ascii=False) + "\n")
-                    valid_count += 1
-                except Exception as e:
-                    invalid_count += 1
-                    # 原样写出无效记录，便于后续排查
-                    f_bad.write(conv_str + "\n")
-                    if len(errors) < 20:
-                        errors.append(f"记录 {idx}: {repr(e)}")
+                        invalid_count += 1
+                        # 原样写出无效记录，便于后续排查
+                        bad_buf.append((conv_str if type(conv_str) is bytes else conv_str.encode("utf-8")) + b"\n")
+                        if len(bad_buf) >= WRITE_BATCH_LINES:
+                            f_bad.writelines(bad_buf)
+                            bad_buf.clear()
+                        if len(errors) < 20:
+                            errors.append(f"记录 {idx}: {payload}")
+                    # 达到上限立即停止，不再多取下一条（并行时由 processed.close() 取消排队中的任务）
+                    if max_records and valid_count + invalid_count >= max_records:
+                        break
+            finally:
+                f_ok.writelines(ok_buf)
+                f_bad.writelines(bad_buf)
+                processed.close()
 
         print("✅ 导出完成")
         print(f"📦 来源表: {table}")
         print(f"🧮 总读取条数: {total}")
         print(f"🟢 有效: {valid_count}  | 🔴 无效: {invalid_count}")
+        if probe_skipped_count:
+            print(f"⏭️ 预筛跳过（原文不含 function_call，未解析校验）: {probe_skipped_count}")
+        if dedup:
+            print(f"♻️ 重复跳过: {dedup_stats['duplicates']}")
         if valid_count:
             print(f"🛠️ 含工具调用: {with_tool_count} ({with_tool_count / max(valid_count,1):.1%} of valid)")
             print(f"🗣️ 含助手文本: {with_gpt_count} ({with_gpt_count / max(valid_count,1):.1%} of valid)")
@@ -399,6 +612,9 @@ def parse_args():
     p.add_argument("--max-records", type=int, default=0, help="最多处理多少条（0 表示不限制）")
     p.add_argument("--format", default="sharegpt", choices=["sharegpt", "openai"], help="导出格式：sharegpt 或 openai")
     p.add_argument("--tools-schema", default="auto", choices=["auto", "yes", "no", "derive"], help="tools 签名策略：auto(默认)/yes/no/derive")
+    p.add_argument("--workers", type=int, default=1, help="并行解析的进程数（默认 1 为单进程；0 表示 CPU 核数）")
+    p.add_argument("--dedup", action="store_true", help="跳过 conversation 内容完全相同的重复记录")
+    p.add_argument("--fast-passthrough", action="store_true", help="sharegpt 格式下未改写的记录直接写出原文（保留库中原有格式，不重新序列化）")
     return p.parse_args()
 
 if __name__ == "__main__":
@@ -417,6 +633,9 @@ if __name__ == "__main__":
         model_filter=args.model_filter,
         max_records=args.max_records,
         out_format=args.format,
-        tools_schema_mode=args.tools_schema
+        tools_schema_mode=args.tools_schema,
+        workers=args.workers or os.cpu_count() or 1,
+        dedup=args.dedup,
+        fast_passthrough=args.fast_passthrough
     )
     print("🎉 完成")
\ No newline at end of file
@@ -1,4 +1,5 @@
 import json
+import orjson
 import logging
 import time
 import asyncio
@@ -6,30 +7,46 @@ import uuid
 from aiohttp import web
 import aiohttp
 import argparse
-from typing import Dict, Any, Optional
-import traceback
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Mapping
 
 # 流式日志采样频率（每收到 N 条增量打印一次调试日志）
 STREAM_DEBUG_SAMPLE_N = 50
+# 流式转发时每次从上游读取的最大字节数
+STREAM_CHUNK_SIZE = 16384
 
 
-from utils import format_to_sharegpt, init_async_logger, get_async_logger, init_db_path, get_db_connection, save_conversation_async
+from utils import format_to_sharegpt, init_async_logger, get_async_logger, init_db_path, get_db_connection, save_conversations_batch_async, encode_conversation, queue_logger_handlers
 import re
-from aiohttp.web_middlewares import middleware
 
 
 
 import os
+import atexit
+
+# 可选：安装 aiodns 后使用 c-ares 异步 DNS 解析，避免每次解析都进入线程池
+try:
+    import aiodns  # noqa: F401
+    from aiohttp.resolver import AsyncResolver
+except ImportError:
+    AsyncResolver = None
 
 # 空异步日志器，避免初始化前的 None 方法调用
 class NullAsyncLogger:
-    async def debug(self, msg: str):
+    # 与 AsyncLogger.logger 对应的同步日志器（已禁用），供同步解析函数直接调用
+    logger = logging.Logger("null_async_logger")
+    logger.disabled = True
+    def isEnabledFor(self, level: int) -> bool:
+        return False
+    async def debug(self, msg: str, *args, **kwargs):
+        pass
+    async def info(self, msg: str, *args, **kwargs):
         pass
-    async def info(self, msg: str):
+    async def warning(self, msg: str, *args, **kwargs):
         pass
-    async def warning(self, msg: str):
+    async def error(self, msg: str, *args, **kwargs):
         pass
-    async def error(self, msg: str):
+    def close(self):
         pass
 
 # ——— 角色规范化（入库轻量纠正） ———
@@ -101,8 +118,7 @@ class ProbeRequestFilter(logging.Filter):
             self._load_config(config_file)
         
         # 编译正则表达式以提高性能
-        all_patterns = self.probe_patterns + self.probe_ip_patterns
-        self.compiled_patterns = [re.compile(pattern) for pattern in all_patterns]
+        self._rebuild_union()
     
     def _load_config(self, config_file: str):
         """从配置文件加载自定义过滤模式"""
@@ -142,33 +158,44 @@ class ProbeRequestFilter(logging.Filter):
             # 配置文件加载失败时使用默认配置
             print(f"警告: 无法加载探针过滤器配置文件 {config_file}: {e}")
     
+    def _rebuild_union(self):
+        """将全部模式合并为一个交替正则，单次 search 即可判断是否命中任一模式"""
+        all_patterns = self.probe_patterns + self.probe_ip_patterns
+        if all_patterns:
+            self._union_re = re.compile('|'.join(f'(?:{p})' for p in all_patterns))
+        else:
+            self._union_re = None
+    
     def add_pattern(self, pattern: str):
         """动态添加过滤模式"""
         try:
-            compiled_pattern = re.compile(pattern)
-            self.compiled_patterns.append(compiled_pattern)
-            self.probe_patterns.append(pattern)
+            re.compile(pattern)
         except re.error as e:
             print(f"警告: 无效的正则表达式模式 '{pattern}': {e}")
+            return
+        self.probe_patterns.append(pattern)
+        self._rebuild_union()
     
     def remove_pattern(self, pattern: str):
         """动态移除过滤模式"""
         if pattern in self.probe_patterns:
             self.probe_patterns.remove(pattern)
-            # 重新编译所有模式
-            all_patterns = self.probe_patterns + self.probe_ip_patterns
-            self.compiled_patterns = [re.compile(p) for p in all_patterns]
+            # 重新编译合并后的模式
+            self._rebuild_union()
+    
+    def matches(self, message: str) -> bool:
+        """判断消息是否命中任一探针模式"""
+        return self._union_re is not None and self._union_re.search(message) is not None
     
     def filter(self, record):
-        """过滤日志记录"""
-        message = record.getMessage()
-        
-        # 检查是否匹配任何探针模式
-        for pattern in self.compiled_patterns:
-            if pattern.search(message):
-                return False  # 过滤掉这条日志
-        
-        return True  # 保留这条日志
+        """过滤日志记录：命中任一探针模式则过滤掉"""
+        if self._union_re is None:
+            return True
+        # 无参数的记录（如 aiohttp 访问日志）msg 已是最终文本，免去 getMessage 的格式化
+        msg = record.msg
+        if record.args or not isinstance(msg, str):
+            msg = record.getMessage()
+        return self._union_re.search(msg) is None
 
 def parse_args():
     parser = argparse.ArgumentParser(description="动态代理端点服务器")
@@ -179,7 +206,11 @@ def parse_args():
 args = parse_args()
 
 # 配置日志
-logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+LOG_LEVEL = getattr(logging, args.log_level.upper())
+logging.basicConfig(level=LOG_LEVEL)
+# 根日志器（含 aiohttp.access / aiohttp.server）的输出改由后台线程写出
+_root_log_listener = queue_logger_handlers(logging.getLogger())
+atexit.register(_root_log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # 清除现有的处理器
@@ -207,64 +238,36 @@ def handle_asyncio_exception(loop, context):
     """处理asyncio中未捕获的异常"""
     exception = context.get('exception')
     if exception:
-        # 检查是否是探针相关的异常
-        error_message = str(exception)
-        probe_filter_instance = ProbeRequestFilter()
-        
-        # 创建一个模拟的日志记录来测试过滤器
-        class MockRecord:
-            def getMessage(self):
-                return error_message
-        
-        mock_record = MockRecord()
-        if not probe_filter_instance.filter(mock_record):
+        # 检查是否是探针相关的异常（复用全局过滤器，与日志过滤规则一致）
+        if probe_filter.matches(str(exception)):
             return  # 如果是探针相关异常，忽略它
         
         logger.error(f"未捕获的asyncio异常: {exception}", exc_info=exception)
     else:
         logger.error(f"未捕获的asyncio错误: {context}")
 
-@middleware
-async def probe_request_middleware(request, handler):
-    """中间件：过滤探针请求"""
-    # 获取客户端IP
-    client_ip = request.remote
-    if 'X-Forwarded-For' in request.headers:
-        client_ip = request.headers['X-Forwarded-For'].split(',')[0].strip()
-    elif 'X-Real-IP' in request.headers:
-        client_ip = request.headers['X-Real-IP']
-    
-    # 检查是否为探针请求
-    user_agent = request.headers.get('User-Agent', '')
-    path = request.path
-    method = request.method
-    
-    # 探针请求特征（可配置）
-    cfg = request.app.get('config', {}) if hasattr(request, 'app') else {}
+def build_probe_rules(cfg: dict) -> tuple:
+    """
+    由配置生成探针判定规则（启动时构建一次，中间件直接复用）：
+    (IP 黑名单集合, 允许方法集合, 路径黑名单集合, 路径前缀元组, UA 子串元组)
+    """
     probe_cfg = cfg.get('probe_request', {}) if isinstance(cfg, dict) else {}
     path_blocklist = probe_cfg.get('path_blocklist', ['/', '/favicon.ico'])
     path_prefix_blocklist = probe_cfg.get('path_prefix_blocklist', ['/.well-known/', '/locales/'])
     ua_blocklist = probe_cfg.get('user_agent_substrings', ['CensysInspect', 'Go-http-client'])
     methods_allowed = probe_cfg.get('allowed_methods', ['GET', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS'])
     ip_blocklist = probe_cfg.get('ip_blocklist', ['193.34.212.110', '185.191.127.222', '162.142.125.124', '194.62.248.69', '209.38.219.203'])
-    
-    probe_indicators = [
-        (path in path_blocklist) or any(path.startswith(p) for p in path_prefix_blocklist),
-        any(s in user_agent for s in ua_blocklist),
-        method not in methods_allowed,
-        client_ip in ip_blocklist
-    ]
-    
-    if any(probe_indicators):
-        # 静默返回404，不记录日志
-        return web.Response(status=404, text="Not Found")
-    
-    # 正常请求，继续处理
-    return await handler(request)
+    return (
+        frozenset(ip_blocklist),
+        frozenset(methods_allowed),
+        frozenset(path_blocklist),
+        tuple(path_prefix_blocklist),
+        tuple(ua_blocklist),
+    )
 
 # ========== 代码层安全中间件（Host/Method/Path/限流/体积/响应头）==========
 import re as _sec_re
-from typing import Dict as _SecDict
+from collections import OrderedDict
 
 # 默认配置（可通过 config.json 覆盖，键路径见下）
 _DEFAULT_SECURITY_CFG = {
@@ -291,93 +294,146 @@ _DEFAULT_SECURITY_CFG = {
     "enforce_json": True  # POST 请求强制 Content-Type: application/json
 }
 
-# 令牌桶
-_RATE_BUCKETS: _SecDict[str, _SecDict[str, float]] = {}
+# 令牌桶（每 IP 一个；按最近访问顺序排列，超过上限时淘汰最久未访问的 IP，防止分布式扫描撑爆内存）
+class _Bucket:
+    __slots__ = ("tokens", "ts")
 
-def _get_security_cfg(app) -> dict:
-    cfg = (app.get("config") or {}) if hasattr(app, "get") else {}
+    def __init__(self, tokens: float, ts: float):
+        self.tokens = tokens
+        self.ts = ts
+
+_RATE_BUCKETS_MAX = 50000
+_RATE_BUCKETS: "OrderedDict[str, _Bucket]" = OrderedDict()
+
+# “连续多斜杠”模式，命中时给出友好提示而非 404
+_MULTI_SLASH_PATTERN = r"//+"
+
+def _compile_susp_patterns(patterns: list) -> tuple:
+    """
+    将恶意路径模式合并为交替正则：(全部模式, “//+” 之前的模式, 是否包含 “//+”)。
+    原先按顺序逐个匹配、以首个命中的模式决定响应；以 // 开头的路径只有在 “//+” 之前的模式都未命中时才返回提示，
+    第二个正则用于保持这一判定
+    """
+    def union(ps):
+        return _sec_re.compile("|".join(f"(?:{p})" for p in ps), _sec_re.I) if ps else None
+    if _MULTI_SLASH_PATTERN in patterns:
+        return union(patterns), union(patterns[:patterns.index(_MULTI_SLASH_PATTERN)]), True
+    return union(patterns), None, False
+
+# 预编译恶意路径正则
+_SUSP_RE = _compile_susp_patterns(_DEFAULT_SECURITY_CFG["suspicious_patterns"])
+
+def build_security_cfg(cfg: dict) -> dict:
+    """
+    合并默认安全配置与 config.security（启动时构建一次，中间件直接复用）。
+    额外预处理出以下划线开头的键：_allowed_hosts/_allowed_methods（集合）、_susp_re（_compile_susp_patterns 结果）、
+    _rate/_burst/_max_body_size（已转换类型的数值）
+    """
     sec = (cfg.get("security") or {}) if isinstance(cfg, dict) else {}
     merged = dict(_DEFAULT_SECURITY_CFG)
     for k, v in sec.items():
         merged[k] = v
+    merged["_allowed_hosts"] = frozenset(h.lower() for h in merged.get("allowed_hosts", []))
+    merged["_allowed_methods"] = frozenset(merged["allowed_methods"])
+    patterns = merged.get("suspicious_patterns") or []
+    # 未覆盖 patterns 时直接复用模块级预编译结果
+    merged["_susp_re"] = _SUSP_RE if patterns == _DEFAULT_SECURITY_CFG["suspicious_patterns"] else _compile_susp_patterns(patterns)
+    merged["_rate"] = float(merged.get("rate", _DEFAULT_SECURITY_CFG["rate"]))
+    merged["_burst"] = int(merged.get("burst", _DEFAULT_SECURITY_CFG["burst"]))
+    merged["_max_body_size"] = int(merged.get("max_body_size", _DEFAULT_SECURITY_CFG["max_body_size"]))
     return merged
 
-@web.middleware
-async def host_and_method_guard_mw(request: web.Request, handler):
-    sec = _get_security_cfg(request.app)
-    # Host 白名单（仅在开启时生效）
-    if sec.get("enforce_host", False):
-        host = request.headers.get("Host", "")
-        hostname = host.split(":")[0].lower()
-        if hostname not in set(h.lower() for h in sec.get("allowed_hosts", [])):
-            return web.Response(status=403, text="Forbidden")
-    # Method 白名单
-    if request.method not in set(sec["allowed_methods"]):
-        return web.Response(status=405, text="Method Not Allowed")
-    # 可选：POST 必须是 JSON
-    if sec.get("enforce_json", True) and request.method == "POST":
-        ctype = request.headers.get("Content-Type", "")
-        if "application/json" not in ctype:
-            return web.Response(status=415, text="Unsupported Media Type")
-    return await handler(request)
-
-# 预编译恶意路径正则
-_SUSP_RE = [_sec_re.compile(p, _sec_re.I) for p in _DEFAULT_SECURITY_CFG["suspicious_patterns"]]
+def _get_security_cfg(app) -> dict:
+    sec = app.get("security_cfg") if hasattr(app, "get") else None
+    if sec is None:
+        sec = build_security_cfg((app.get("config") or {}) if hasattr(app, "get") else {})
+    return sec
 
-@web.middleware
-async def path_guard_mw(request: web.Request, handler):
-    sec = _get_security_cfg(request.app)
-    patterns = sec.get("suspicious_patterns") or []
-    # 若配置覆盖了 patterns，重新按配置编译一次
-    regexes = _SUSP_RE if patterns == _DEFAULT_SECURITY_CFG["suspicious_patterns"] else [
-        _sec_re.compile(p, _sec_re.I) for p in patterns
-    ]
-    path = request.rel_url.path
-    for r in regexes:
-        if r.search(path):
-            # 对“连续多斜杠”给出更友好的提示，便于用户修正
-            if r.pattern == r"//+" and path.startswith("//"):
-                err = {
-                    "error": "路径包含连续斜杠，请改为单斜杠",
-                    "hint": "示例：/api.openai.com/v1/chat/completions 或 /generativelanguage.googleapis.com/...",
-                    "note": "如目标域名未在白名单，请在 config.json 的 allowed_domains 中添加"
-                }
-                return web.Response(status=400, text=json.dumps(err, ensure_ascii=False), headers={"Content-Type": "application/json"})
-            return web.Response(status=404, text="Not Found")
-    return await handler(request)
+# 连续多斜杠的友好提示（固定内容，预先编码）
+_ERR_DOUBLE_SLASH = orjson.dumps({
+    "error": "路径包含连续斜杠，请改为单斜杠",
+    "hint": "示例：/api.openai.com/v1/chat/completions 或 /generativelanguage.googleapis.com/...",
+    "note": "如目标域名未在白名单，请在 config.json 的 allowed_domains 中添加"
+})
 
 def _allow_ip(ip: str, rate: float, burst: int) -> bool:
-    now = time.time()
+    # 单调时钟：系统时间回拨不会导致令牌计算异常
+    now = time.monotonic()
     b = _RATE_BUCKETS.get(ip)
     if b is None:
-        _RATE_BUCKETS[ip] = {"tokens": burst - 1, "ts": now}
+        _RATE_BUCKETS[ip] = _Bucket(burst - 1, now)
+        if len(_RATE_BUCKETS) > _RATE_BUCKETS_MAX:
+            _RATE_BUCKETS.popitem(last=False)
         return True
-    elapsed = now - b["ts"]
-    b["ts"] = now
-    b["tokens"] = min(burst, b["tokens"] + elapsed * rate)
-    if b["tokens"] >= 1.0:
-        b["tokens"] -= 1.0
+    _RATE_BUCKETS.move_to_end(ip)
+    tokens = min(burst, b.tokens + (now - b.ts) * rate)
+    b.ts = now
+    if tokens >= 1.0:
+        b.tokens = tokens - 1.0
         return True
+    b.tokens = tokens
     return False
 
 @web.middleware
-async def rate_limit_mw(request: web.Request, handler):
-    sec = _get_security_cfg(request.app)
-    rate = float(sec.get("rate", _DEFAULT_SECURITY_CFG["rate"]))
-    burst = int(sec.get("burst", _DEFAULT_SECURITY_CFG["burst"]))
-    xff = request.headers.get("X-Forwarded-For", "")
-    ip = (xff.split(",")[0].strip() if xff else request.remote) or "unknown"
-    if not _allow_ip(ip, rate, burst):
+async def pre_guard_mw(request: web.Request, handler):
+    """
+    路由前的统一安全检查：Host/Method、恶意路径、限流、请求体大小、探针特征。
+    请求头只读取一次，按上述顺序判断（顺序决定返回码与限流计数），任一命中即直接返回
+    """
+    app = request.app
+    sec = _get_security_cfg(app)
+    headers = request.headers
+    method = request.method
+    
+    # Host 白名单（仅在开启时生效）
+    if sec.get("enforce_host", False):
+        hostname = headers.get("Host", "").split(":")[0].lower()
+        if hostname not in sec["_allowed_hosts"]:
+            return web.Response(status=403, text="Forbidden")
+    # Method 白名单
+    if method not in sec["_allowed_methods"]:
+        return web.Response(status=405, text="Method Not Allowed")
+    # 可选：POST 必须是 JSON
+    if sec.get("enforce_json", True) and method == "POST":
+        if "application/json" not in headers.get("Content-Type", ""):
+            return web.Response(status=415, text="Unsupported Media Type")
+    
+    # 恶意路径
+    path = request.rel_url.path
+    susp_re, pre_slash_re, has_multi_slash = sec["_susp_re"]
+    if susp_re is not None and susp_re.search(path):
+        # 对“连续多斜杠”给出更友好的提示，便于用户修正
+        if has_multi_slash and path.startswith("//") and (pre_slash_re is None or pre_slash_re.search(path) is None):
+            return web.Response(status=400, body=_ERR_DOUBLE_SLASH, headers={"Content-Type": "application/json"})
+        return web.Response(status=404, text="Not Found")
+    
+    # 限流（按 X-Forwarded-For 首个地址，缺失时用对端地址）
+    xff = headers.get("X-Forwarded-For")
+    xff_ip = xff.partition(",")[0].strip() if xff else None
+    if not _allow_ip((xff_ip if xff else request.remote) or "unknown", sec["_rate"], sec["_burst"]):
         return web.Response(status=429, text="Too Many Requests")
-    return await handler(request)
-
-@web.middleware
-async def max_body_mw(request: web.Request, handler):
-    sec = _get_security_cfg(request.app)
-    max_size = int(sec.get("max_body_size", _DEFAULT_SECURITY_CFG["max_body_size"]))
-    cl = request.headers.get("Content-Length")
-    if cl and cl.isdigit() and int(cl) > max_size:
+    
+    # 请求体大小
+    cl = headers.get("Content-Length")
+    if cl and cl.isdigit() and int(cl) > sec["_max_body_size"]:
         return web.Response(status=413, text="Payload Too Large")
+    
+    # 探针请求特征（可配置，启动时已构建为集合/元组），命中即静默返回404，不记录日志
+    rules = app.get("probe_rules")
+    if rules is None:
+        rules = build_probe_rules(app.get("config", {}))
+    ip_set, method_set, path_set, path_prefixes, ua_subs = rules
+    client_ip = xff_ip if xff else (headers.get("X-Real-IP") or request.remote)
+    if (client_ip in ip_set
+            or method not in method_set
+            or path in path_set
+            or path.startswith(path_prefixes)):
+        return web.Response(status=404, text="Not Found")
+    user_agent = headers.get("User-Agent", "")
+    for sub in ua_subs:
+        if sub in user_agent:
+            return web.Response(status=404, text="Not Found")
+    
     return await handler(request)
 
 @web.middleware
@@ -391,11 +447,131 @@ async def security_headers_mw(request: web.Request, handler):
     resp.headers["Content-Security-Policy"] = "default-src 'none'; frame-ancestors 'none'; base-uri 'none'"
     return resp
 
+# Google 路径中的模型名：/v1beta/models/{model}:generateContent
+_MODEL_PATH_RE = re.compile(r'/v1beta/models/([^:]+)')
+# 路径 -> 认证类型：按 Google、Anthropic 的优先级用前瞻一次匹配；
+# 其余（/v1/chat/completions、/v1/embeddings、/v1/rerank 等）均按 openai 处理
+_AUTH_PATH_RE = re.compile(
+    r'(?P<google>(?=.*/v1beta/models/)(?=.*:generateContent))'
+    r'|(?P<anthropic>(?=.*(?:/anthropic/|/v1/messages)))'
+)
+# OpenAI 兼容接口的上游超时（所有请求共用同一对象）
+_OPENAI_TIMEOUT = aiohttp.ClientTimeout(total=120)
+
+def _reasoning_items_text(items: list) -> str:
+    return "".join(x.get("text", "") if isinstance(x, dict) else str(x) for x in items)
+
+def _reasoning_dict_text(rc: dict) -> str:
+    buf = []
+    for k in ("text", "content", "message"):
+        v = rc.get(k)
+        if isinstance(v, str):
+            buf.append(v)
+        elif isinstance(v, list):
+            buf.append(_reasoning_items_text(v))
+    parts = rc.get("parts")
+    if isinstance(parts, list):
+        buf.append(_reasoning_items_text(parts))
+    return "".join(buf)
+
+# reasoning_content 的多种结构（字符串 / 含 text|content|message|parts 的对象 / 数组）按类型分派展开
+_REASONING_FLATTENERS = {str: lambda rc: rc, dict: _reasoning_dict_text, list: _reasoning_items_text}
+
+def _flatten_reasoning(rc) -> str:
+    """将任意结构的 reasoning_content 展开为文本；其余类型按 str() 兜底"""
+    return _REASONING_FLATTENERS.get(type(rc), str)(rc)
+
+# OpenAI 角色 -> Google contents 角色
+_GOOGLE_ROLE_MAP = {'system': 'user', 'user': 'user', 'assistant': 'model'}
+
+# allowed_domains 查表未命中的哨兵
+_DOMAIN_NOT_FOUND = object()
+
+# 固定的错误响应体，预先编码
+_ERR_PAYLOAD_TOO_LARGE = orjson.dumps({"error": "请求体过大，请减小输入数据大小或分批处理"})
+_ERR_MISSING_AUTH = orjson.dumps({"error": "缺少有效的Authorization头"})
+_ERR_UPSTREAM_TIMEOUT = orjson.dumps({"error": "连接超时，请稍后重试"})
+_ERR_BAD_REQUEST = orjson.dumps({"error": "无效的请求数据格式"})
+_ERR_INTERNAL = orjson.dumps({"error": "服务器内部错误"})
+
+# 归档时思考过程的包裹格式：<think>\n{reasoning}\n</think>\n\n{response}
+_THINK_OPEN = "<think>\n"
+_THINK_CLOSE = "\n</think>\n\n"
+
+def _with_think(reasoning: str, response: str) -> str:
+    """把思考过程以 <think> 块的形式拼接在回答之前"""
+    return f"{_THINK_OPEN}{reasoning}{_THINK_CLOSE}{response}"
+
+def _dumps_for_log(obj) -> str:
+    """调试日志用的 JSON 序列化（orjson 紧凑输出，保留中文）"""
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+@dataclass
+class QueuedConversation:
+    """待批量入库的一条对话（__slots__：队列中可能积压上千条，省去每条的 __dict__）"""
+    __slots__ = ('id', 'model', 'conversation', 'timestamp')
+    id: Optional[str]
+    model: str
+    conversation: dict
+    timestamp: float
+
+def _serialize_batch(batch: list) -> tuple:
+    """校验并格式化一批对话（同步函数，在线程池中执行）。
+    返回 (入库行 [(id, model, conversation JSON 文本)], 调试明细 [(messages, response, sharegpt_data)], 错误信息列表)"""
+    rows, details, errors = [], [], []
+    for conversation_data in batch:
+        # 检查数据结构
+        if not isinstance(conversation_data, QueuedConversation):
+            errors.append(f"无效的对话数据类型: {type(conversation_data)}")
+            continue
+        
+        conversation = conversation_data.conversation
+        if not isinstance(conversation, dict):
+            errors.append(f"conversation字段类型错误: {type(conversation)}")
+            continue
+        
+        # 格式化为ShareGPT格式
+        # 优先使用conversation中的messages，如果没有则使用request中的messages
+        messages = conversation.get('messages', conversation.get('request', {}).get('messages', []))
+        # 入库轻量纠正：修复“连续两个 user 且第二条像 AI 回答”
+        norm_changed = False
+        try:
+            messages, norm_changed = normalize_roles(messages)
+        except Exception:
+            norm_changed = False
+        if norm_changed:
+            # 审计标记 + 保留原始请求
+            try:
+                flags = conversation.setdefault('flags', [])
+                if 'normalized_roles' not in flags:
+                    flags.append('normalized_roles')
+                conversation.setdefault('request_raw', conversation.get('request', {}))
+            except Exception:
+                pass
+        
+        response = conversation.get('response', '')
+        sharegpt_data = format_to_sharegpt(
+            conversation_data.model,
+            messages,
+            response,
+            conversation.get('request', {})
+        )
+        try:
+            encoded = encode_conversation(sharegpt_data)
+        except Exception as e:
+            # 单条无法序列化只跳过该条，不影响同批其他对话
+            errors.append(f"序列化对话 {conversation_data.id} 失败，已跳过: {e}")
+            continue
+        details.append((messages, response, sharegpt_data))
+        rows.append((conversation_data.id, conversation_data.model, encoded))
+    return rows, details, errors
+
 class DynamicProxyEndpoint:
     """动态代理端点，无需配置文件"""
     
     def _extract_messages_for_archive(self, auth_type: str, request_data: Dict[str, Any]) -> list[dict]:
-        """从请求体中抽取归档用的 messages，兼容 Google contents 与 OpenAI messages；正确映射 user/model/system"""
+        """从请求体中抽取归档用的 messages，兼容 Google contents 与 OpenAI messages；正确映射 user/model/system。
+        非 Google 路径直接返回请求中的 messages 列表（不复制），调用方需按只读使用"""
         msgs: list[dict] = []
         try:
             if auth_type == "google":
@@ -470,28 +646,29 @@ class DynamicProxyEndpoint:
         # 应用与中间件（顺序：快速拒绝 -> 限流/体积 -> 兼容旧探针过滤 -> 安全头）
         self.app = web.Application(
             middlewares=[
-                host_and_method_guard_mw,
-                path_guard_mw,
-                rate_limit_mw,
-                max_body_mw,
-                probe_request_middleware,
+                pre_guard_mw,
                 security_headers_mw,
             ],
             client_max_size=client_max_size
         )
         # 让中间件可读取配置
         self.app["config"] = self.config
+        self.app["probe_rules"] = build_probe_rules(self.config)
+        self.app["security_cfg"] = build_security_cfg(self.config)
 
         self.setup_routes()
         
         # 性能优化相关
         self.http_session = None
         self.async_logger = NullAsyncLogger()
+        # 是否输出 DEBUG 日志（日志级别启动后不变，缓存以便热路径直接判断）
+        self._debug = False
         # 预置一个队列，启动时会覆盖
         self.conversation_queue = asyncio.Queue(maxsize=1000)
         self.batch_size = 10
         self.batch_timeout = 5.0
         self.batch_save_task = None  # 添加批量保存任务的引用
+        self._db_conn = None  # 批量保存复用的长连接，首次保存时建立，清理时关闭
         
         # 域名白名单和认证映射
         # 最小白名单（完整列表迁移至 config.json）
@@ -507,6 +684,11 @@ class DynamicProxyEndpoint:
                 self.allowed_domains = cfg_domains
         except Exception:
             pass
+        # 预先拼好各域名的 URL 前缀（协议 + 域名）
+        self._domain_base = {
+            d: ('https://' if (c.get('https', True) if isinstance(c, dict) else True) else 'http://') + d
+            for d, c in self.allowed_domains.items()
+        }
         
         # 设置应用启动和清理事件
         self.app.on_startup.append(self.init_async_resources)
@@ -531,14 +713,17 @@ class DynamicProxyEndpoint:
         loop.set_exception_handler(handle_asyncio_exception)
         
         # 初始化异步日志
-        await asyncio.to_thread(init_async_logger, "proxy_dynamic", "proxy_dynamic.log", getattr(logging, args.log_level.upper()))
+        await asyncio.to_thread(init_async_logger, "proxy_dynamic", "proxy_dynamic.log", LOG_LEVEL)
         self.async_logger = get_async_logger()
         if self.async_logger is None:
             raise ValueError("Failed to initialize async_logger")
+        self._debug = self.async_logger.isEnabledFor(logging.DEBUG)
         await self.async_logger.info("✅ 异步日志初始化完成")
         
         # 将配置注入app，供中间件等使用
         self.app['config'] = getattr(self, 'config', {})
+        self.app['probe_rules'] = build_probe_rules(self.app['config'])
+        self.app['security_cfg'] = build_security_cfg(self.app['config'])
         
         # 初始化数据库
         await init_db_path("interactions.db")
@@ -546,12 +731,13 @@ class DynamicProxyEndpoint:
         
         # 初始化HTTP连接池
         connector = aiohttp.TCPConnector(
-            limit=100,
-            limit_per_host=30,
-            ttl_dns_cache=300,
+            limit=200,
+            limit_per_host=64,  # 流式请求长时间占用连接，单上游需要更多并发
+            ttl_dns_cache=600,  # 上游 API 域名稳定，延长 DNS 缓存
             use_dns_cache=True,
-            keepalive_timeout=30,
-            enable_cleanup_closed=True
+            keepalive_timeout=60,
+            enable_cleanup_closed=True,
+            resolver=AsyncResolver() if AsyncResolver is not None else None
         )
         
         timeout = aiohttp.ClientTimeout(
@@ -602,31 +788,22 @@ class DynamicProxyEndpoint:
                 if self.async_logger:
                     await self.async_logger.info(f"💾 保存了 {len(remaining_conversations)} 条剩余对话数据")
         
+        # 所有保存结束后再关闭数据库长连接
+        await self._close_db_conn()
+        
         # 关闭HTTP会话
         if self.http_session:
             await self.http_session.close()
             
         if self.async_logger:
             await self.async_logger.info("🔄 资源清理完成")
+            # 批量保存已结束，停止日志监听线程并写出剩余日志
+            self.async_logger.close()
     
     def detect_auth_type_from_path(self, path: str) -> str:
-        """根据路径模式识别认证类型"""
-        # Google Gemini API 路径模式
-        if "/v1beta/models/" in path and ":generateContent" in path:
-            return "google"
-        # Anthropic API 路径模式
-        elif "/anthropic/" in path or "/v1/messages" in path:
-            return "anthropic"
-        # OpenAI API 路径模式
-        elif "/v1/chat/completions" in path or "/chat/completions" in path:
-            return "openai"
-        elif "/v1/embeddings" in path:
-            return "openai"
-        elif "/v1/rerank" in path:
-            return "openai"
-        else:
-            # 默认使用openai格式
-            return "openai"
+        """根据路径模式识别认证类型（未命中 Google/Anthropic 特征时默认 openai）"""
+        m = _AUTH_PATH_RE.match(path)
+        return m.lastgroup if m else "openai"
     
     def extract_model_from_request(self, request_data: Dict[str, Any], path: str, auth_type: str) -> str:
         """从请求中提取模型名称"""
@@ -634,15 +811,14 @@ class DynamicProxyEndpoint:
         if auth_type == "google" and "/v1beta/models/" in path:
             # 路径格式: /v1beta/models/gemini-pro:generateContent
             # 或: /v1beta/models/gemini-2.5-pro:streamGenerateContent
-            import re
-            match = re.search(r'/v1beta/models/([^:]+)', path)
+            match = _MODEL_PATH_RE.search(path)
             if match:
                 return match.group(1)
         
         # 对于其他API，从请求体中获取模型名称
         return request_data.get("model", "unknown")
     
-    def prepare_auth_headers(self, request_headers: Dict[str, str], auth_type: str) -> Dict[str, str]:
+    def prepare_auth_headers(self, request_headers: Mapping[str, str], auth_type: str) -> Dict[str, str]:
         """根据认证类型准备请求头：保留 Authorization 与所有 x-* 头，补充 Content-Type"""
         forward_headers: Dict[str, str] = {"Content-Type": "application/json"}
         for k, v in request_headers.items():
@@ -651,32 +827,33 @@ class DynamicProxyEndpoint:
                 forward_headers[k] = v
         return forward_headers
     
-    def is_domain_allowed(self, domain: str) -> bool:
-        """检查域名是否在白名单中"""
-        return domain in self.allowed_domains
-    
     def get_target_url(self, domain: str, path: str) -> str:
         """构建目标URL"""
-        domain_config = self.allowed_domains.get(domain, {'https': True})
-        protocol = 'https' if domain_config.get('https', True) else 'http'
+        base = self._domain_base.get(domain)
+        if base is None:
+            # 不在白名单中的域名（如 OpenAI 兼容入口的默认目标）按 https 处理
+            base = 'https://' + domain
         # 保留原始路径和查询参数
-        return f"{protocol}://{domain}{path}"
+        return base + path
     
     async def handle_openai_api(self, request: web.Request) -> web.StreamResponse:
         """处理标准OpenAI API端点请求"""
         try:
-            # 获取请求数据
-            headers = dict(request.headers)
-            request_data = await request.json()
+            # 获取请求数据（请求头直接使用大小写不敏感的 request.headers）
+            headers = request.headers
+            raw_body = await request.read()
+            request_data = orjson.loads(raw_body)
             
             # 调试：打印客户端发送的消息
-            await self.async_logger.info(f"🔍 OpenAI API - 客户端请求数据: {json.dumps(request_data, ensure_ascii=False, indent=2)}")
+            if self._debug:
+                await self.async_logger.debug(f"🔍 OpenAI API - 客户端请求数据: {_dumps_for_log(request_data)}")
             
             # 请求体大小检查
-            if not await self._validate_request_size(request_data):
+            if not await self._validate_request_size(request_data, len(raw_body)):
                 return web.Response(
                     status=413,
-                    text=json.dumps({"error": "请求体过大，请减小输入数据大小或分批处理"})
+                    body=_ERR_PAYLOAD_TOO_LARGE,
+                    content_type="application/json"
                 )
             
             # 从请求头中获取Authorization，确定目标域名
@@ -684,7 +861,8 @@ class DynamicProxyEndpoint:
             if not auth_header.startswith('Bearer '):
                 return web.Response(
                     status=401,
-                    text=json.dumps({"error": "缺少有效的Authorization头"})
+                    body=_ERR_MISSING_AUTH,
+                    content_type="application/json"
                 )
             
             # 根据API Key或模型名称确定目标域名
@@ -719,8 +897,8 @@ class DynamicProxyEndpoint:
             async with self.http_session.post(
                 target_url,
                 headers=auth_headers,
-                json=request_data,
-                timeout=aiohttp.ClientTimeout(total=120)
+                data=orjson.dumps(request_data),
+                timeout=_OPENAI_TIMEOUT
             ) as resp:
                 
                 # 检查是否为流式响应
@@ -737,35 +915,28 @@ class DynamicProxyEndpoint:
             await self.async_logger.error(f"❌ OpenAI API处理异常: {e}", exc_info=True)
             return web.Response(
                 status=500,
-                text=json.dumps({"error": f"服务器内部错误: {str(e)}"})
+                body=orjson.dumps({"error": f"服务器内部错误: {str(e)}"}),
+                content_type="application/json"
             )
     
     def _convert_openai_to_google(self, openai_request: Dict[str, Any]) -> Dict[str, Any]:
-        """将OpenAI格式请求转换为Google格式"""
+        """将OpenAI格式请求转换为Google格式（已是 Google 格式则原样返回）"""
+        if 'contents' in openai_request:
+            return openai_request
         messages = openai_request.get('messages', [])
         
-        # 转换消息格式
+        # 转换消息格式（其他角色忽略）
         contents = []
         for msg in messages:
             role = msg.get('role', 'user')
+            google_role = _GOOGLE_ROLE_MAP.get(role)
+            if google_role is None:
+                continue
             content = msg.get('content', '')
-            
             if role == 'system':
                 # Google API中system消息需要特殊处理
-                contents.append({
-                    "role": "user",
-                    "parts": [{"text": f"System: {content}"}]
-                })
-            elif role == 'user':
-                contents.append({
-                    "role": "user", 
-                    "parts": [{"text": content}]
-                })
-            elif role == 'assistant':
-                contents.append({
-                    "role": "model",
-                    "parts": [{"text": content}]
-                })
+                content = f"System: {content}"
+            contents.append({"role": google_role, "parts": [{"text": content}]})
         
         # 构建Google API请求
         google_request = {
@@ -790,35 +961,40 @@ class DynamicProxyEndpoint:
             if request.query_string:
                 path += '?' + request.query_string
             
-            # 安全检查：验证域名白名单
-            if not self.is_domain_allowed(domain):
+            # 安全检查：验证域名白名单（一次查表同时取得域名配置）
+            domain_config = self.allowed_domains.get(domain, _DOMAIN_NOT_FOUND)
+            if domain_config is _DOMAIN_NOT_FOUND:
                 await self.async_logger.warning(f"❌ 不允许的域名: {domain}")
                 return web.Response(
                     status=403,
-                    text=json.dumps({"error": f"域名 {domain} 不在允许列表中"})
+                    body=orjson.dumps({"error": f"域名 {domain} 不在允许列表中"}),
+                    content_type="application/json"
                 )
             
-            # 获取请求数据
-            headers = dict(request.headers)
+            # 获取请求数据（请求头直接使用大小写不敏感的 request.headers）
+            headers = request.headers
             
             # 处理GET请求（无请求体）和POST请求（有请求体）
             if request.method == 'GET':
                 request_data = {}
-                await self.async_logger.debug(f"🔍 调试 - GET请求: {request.method} {path}")
+                if self._debug:
+                    await self.async_logger.debug(f"🔍 调试 - GET请求: {request.method} {path}")
             else:
-                request_data = await request.json()
+                raw_body = await request.read()
+                request_data = orjson.loads(raw_body)
                 # 调试：打印客户端发送的消息
-                await self.async_logger.debug(f"🔍 调试 - 客户端请求数据: {json.dumps(request_data, ensure_ascii=False, indent=2)}")
+                if self._debug:
+                    await self.async_logger.debug(f"🔍 调试 - 客户端请求数据: {_dumps_for_log(request_data)}")
                 
                 # 请求体大小检查（仅对POST请求）
-                if not await self._validate_request_size(request_data):
+                if not await self._validate_request_size(request_data, len(raw_body)):
                     return web.Response(
                         status=413,
-                        text=json.dumps({"error": "请求体过大，请减小输入数据大小或分批处理"})
+                        body=_ERR_PAYLOAD_TOO_LARGE,
+                        content_type="application/json"
                     )
             
             # 根据域名配置或路径识别认证类型
-            domain_config = self.allowed_domains.get(domain, {})
             if 'auth_type' in domain_config:
                 # 优先使用域名配置的认证类型
                 auth_type = domain_config['auth_type']
@@ -838,7 +1014,8 @@ class DynamicProxyEndpoint:
             # Google API特殊处理：检查URL中是否包含streamGenerateContent
             if auth_type == "google" and "streamGenerateContent" in path:
                 is_stream = True
-                await self.async_logger.debug(f"🔍 调试 - Google流式请求检测: URL包含streamGenerateContent，设置为流式")
+                if self._debug:
+                    await self.async_logger.debug(f"🔍 调试 - Google流式请求检测: URL包含streamGenerateContent，设置为流式")
             
             # 解析模型名称
             model = self.extract_model_from_request(request_data, path, auth_type)
@@ -850,6 +1027,10 @@ class DynamicProxyEndpoint:
             # 发送请求（带重试机制）
             max_retries = 3
             retry_delay = 1  # 初始重试延迟（秒）
+            # 请求体只序列化一次，重试时复用同一份字节（Content-Type 已由 prepare_auth_headers 设置）
+            body_bytes = None
+            if request.method != 'GET':
+                body_bytes = orjson.dumps(request_data)
             
             for attempt in range(max_retries):
                 try:
@@ -865,7 +1046,7 @@ class DynamicProxyEndpoint:
                         async with self.http_session.post(
                             target_url,
                             headers=forward_headers,
-                            json=request_data
+                            data=body_bytes
                         ) as resp:
                             if is_stream:
                                 return await self._handle_stream_response(resp, request, auth_type, model, request_data)
@@ -879,18 +1060,22 @@ class DynamicProxyEndpoint:
                         retry_delay *= 2  # 指数退避
                     else:
                         await self.async_logger.error(f"❌ 连接失败，已达到最大重试次数: {str(e)}")
-                        return web.Response(status=500, text=json.dumps({"error": "连接超时，请稍后重试"}))
+                        return web.Response(status=500, body=_ERR_UPSTREAM_TIMEOUT, content_type="application/json")
         
         except json.JSONDecodeError:
             await self.async_logger.error("❌ 无效的请求数据格式")
-            return web.Response(status=400, text=json.dumps({"error": "无效的请求数据格式"}))
+            return web.Response(status=400, body=_ERR_BAD_REQUEST, content_type="application/json")
         except Exception as e:
-            await self.async_logger.error(f"处理动态代理请求时发生错误: {e}\n{traceback.format_exc()}")
-            return web.Response(status=500, text=json.dumps({"error": "服务器内部错误"}))
+            await self.async_logger.error("处理动态代理请求时发生错误: %s", e, exc_info=True)
+            return web.Response(status=500, body=_ERR_INTERNAL, content_type="application/json")
     
-    async def _validate_request_size(self, request_data: Dict[str, Any]) -> bool:
+    async def _validate_request_size(self, request_data: Dict[str, Any], raw_size: Optional[int] = None) -> bool:
         """验证请求体大小（兼容 OpenAI messages 与 Google contents.parts）"""
         max_chars = 8000000
+        # 快速路径：统计的字符数不会超过原始字节数的 3 倍（非字符串 content 按 str() 计，
+        # 不可打印字符的转义最多膨胀约 2.5 倍），原始请求体足够小时无需逐条统计
+        if raw_size is not None and raw_size * 3 <= max_chars:
+            return True
         total_chars = 0
 
         # OpenAI/Anthropic 风格
@@ -930,6 +1115,33 @@ class DynamicProxyEndpoint:
             return False
         return True
     
+    async def _forward_stream_lines(self, resp: aiohttp.ClientResponse, request: web.Request,
+                                    response: web.StreamResponse):
+        """按网络块原样透传上游数据，同时切分出完整的行供解析（最后不带换行的残行也会产出）"""
+        parse_buf = bytearray()
+        async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+            # 增加客户端断开防护
+            transport = getattr(request, "transport", None)
+            if transport is None or transport.is_closing():
+                await self.async_logger.info("🔌 客户端连接已关闭，停止继续写入流式数据")
+                return
+            try:
+                await response.write(chunk)
+            except (ConnectionResetError, BrokenPipeError, aiohttp.ClientConnectionResetError, asyncio.CancelledError):
+                await self.async_logger.info("🔌 客户端断开连接，停止写入")
+                return
+            # 其他异常交由外层捕获
+            
+            parse_buf += chunk
+            if b"\n" not in chunk:
+                continue
+            lines = parse_buf.split(b"\n")
+            parse_buf = lines.pop()
+            for line in lines:
+                yield line
+        if parse_buf:
+            yield parse_buf
+    
     async def _handle_stream_response(self, resp: aiohttp.ClientResponse, request: web.Request,
                                     auth_type: str, model: str, request_data: Dict[str, Any]) -> web.StreamResponse:
         """处理流式响应"""
@@ -939,8 +1151,9 @@ class DynamicProxyEndpoint:
         )
         await response.prepare(request)
         
-        complete_response = ""
-        complete_reasoning = ""
+        # 文本/思考片段先收集到列表，结束时一次性拼接
+        response_chunks: list[str] = []
+        reasoning_chunks: list[str] = []
         response_id = None
         # Anthropic 工具流式解析状态
         anthropic_tool_current = None
@@ -950,40 +1163,23 @@ class DynamicProxyEndpoint:
         stream_debug_counter = 0
         
         try:
-            async for line in resp.content:
-                # 原样透传上游数据，保留换行与空行（增加客户端断开防护）
-                transport = getattr(request, "transport", None)
-                if transport is None or transport.is_closing():
-                    await self.async_logger.info("🔌 客户端连接已关闭，停止继续写入流式数据")
-                    break
-                try:
-                    await response.write(line)
-                  
-                except (ConnectionResetError, BrokenPipeError, aiohttp.ClientConnectionResetError, asyncio.CancelledError):
-                    await self.async_logger.info("🔌 客户端断开连接，停止写入")
-                    break
-                # 其他异常交由外层捕获
-                 
-                # 为日志与解析单独构造字符串，不影响透传
-                try:
-                    line_text = line.decode('utf-8', errors='ignore')
-                except Exception:
-                    line_text = ''
-                line_str = line_text.strip()
+            async for line in self._forward_stream_lines(resp, request, response):
+                # 解析直接基于字节进行（仅在需要时解码），不影响透传
+                line_b = line.strip()
                 
-                if line_str:
+                if line_b:
                     # 调试：高频采样打印，降低噪声
                     stream_debug_counter += 1
                     if stream_debug_counter % STREAM_DEBUG_SAMPLE_N == 1:
-                        await self.async_logger.debug(f"🔍 调试 - 接收到流式数据: {line_str[:200]}...")
+                        if self._debug:
+                            await self.async_logger.debug(f"🔍 调试 - 接收到流式数据: {line_b[:200].decode('utf-8', errors='ignore')}...")
                     
                     # 解析响应内容
                     if auth_type == "anthropic":
                         # 直接解析 JSON 事件，捕获工具调用
-                        if line_str.startswith("data: "):
-                            data_str = line_str[6:].strip()
+                        if line_b.startswith(b"data: "):
                             try:
-                                evt = json.loads(data_str)
+                                evt = orjson.loads(line_b[6:])
                                 etype = evt.get("type")
                                 # 消息开始，记录 id
                                 if etype == "message_start" and "message" in evt and not response_id:
@@ -996,12 +1192,12 @@ class DynamicProxyEndpoint:
                                     if delta.get("type") == "text_delta":
                                         text = delta.get("text", "")
                                         if isinstance(text, str):
-                                            complete_response += text
+                                            response_chunks.append(text)
                                     # 工具输入 JSON 增量
                                     elif delta.get("type") == "input_json_delta":
                                         pj = delta.get("partial_json", "")
                                         if anthropic_tool_current is not None and isinstance(pj, str):
-                                            anthropic_tool_current["input_json"] += pj
+                                            anthropic_tool_current["input_json"].append(pj)
                                 # 工具块开始
                                 elif etype == "content_block_start":
                                     block = evt.get("content_block", {})
@@ -1009,15 +1205,15 @@ class DynamicProxyEndpoint:
                                         anthropic_tool_current = {
                                             "id": block.get("id"),
                                             "name": block.get("name"),
-                                            "input_json": ""
+                                            "input_json": []
                                         }
                                 # 工具块结束，组装一次调用
                                 elif etype == "content_block_stop":
                                     if anthropic_tool_current is not None:
-                                        args_text = anthropic_tool_current.get("input_json", "") or ""
+                                        args_text = "".join(anthropic_tool_current["input_json"])
                                         # 尝试解析为对象；失败则保留原字符串
                                         try:
-                                            parsed_args = json.loads(args_text) if args_text else {}
+                                            parsed_args = orjson.loads(args_text) if args_text else {}
                                         except Exception:
                                             parsed_args = args_text
                                         tool_call = {
@@ -1041,29 +1237,24 @@ class DynamicProxyEndpoint:
                                 # 单事件解析失败不影响透传
                                 pass
                         # 同时复用现有解析以兼容只文本的情况
-                        complete_response, response_id, _ = self._parse_anthropic_stream_chunk(
-                            line_str, complete_response, response_id
+                        response_id = self._parse_anthropic_stream_chunk(
+                            line_b, response_chunks, response_id
                         )
                     elif auth_type == "google":
-                        chunk_reasoning = ""
-                        complete_response, response_id, chunk_reasoning = await self._parse_google_stream_chunk(
-                            line_str, complete_response, response_id
+                        response_id = self._parse_google_stream_chunk(
+                            line_b, response_chunks, reasoning_chunks, response_id
                         )
-                        if chunk_reasoning:
-                            complete_reasoning += chunk_reasoning
                     else:
-                        chunk_reasoning = ""
-                        complete_response, response_id, chunk_reasoning = self._parse_openai_stream_chunk(
-                            line_str, complete_response, response_id
+                        response_id = self._parse_openai_stream_chunk(
+                            line_b, response_chunks, reasoning_chunks, response_id
                         )
-                        if chunk_reasoning:
-                            complete_reasoning += chunk_reasoning
         
         except Exception as e:
-            await self.async_logger.error(f"流式响应处理错误: {e}")
-            await self.async_logger.error(f"错误详情: {traceback.format_exc()}")
+            await self.async_logger.error("流式响应处理错误: %s", e, exc_info=True)
         
         finally:
+            complete_response = "".join(response_chunks)
+            complete_reasoning = "".join(reasoning_chunks)
             # 保存对话 - 处理不同API格式的消息转换
             # 修改：当存在工具调用时（Anthropic stop_reason=tool_use），即使没有可见文本也保存
             save_due_to_tool = (auth_type == "anthropic" and len(anthropic_tool_calls) > 0)
@@ -1078,7 +1269,7 @@ class DynamicProxyEndpoint:
                     # 默认降为 DEBUG，如需 INFO 级别审计，设置环境变量 PROXY_AUDIT_TOOL_SAVE
                     if os.getenv("PROXY_AUDIT_TOOL_SAVE"):
                         await self.async_logger.info(f"📌 保存于工具阶段（function_call-only），数量={len(anthropic_tool_calls)}，工具={tool_names}")
-                    else:
+                    elif self._debug:
                         await self.async_logger.debug(f"📌 保存于工具阶段（function_call-only），数量={len(anthropic_tool_calls)}，工具={tool_names}")
                 # 处理不同API格式的消息转换
                 # 统一抽取归档消息，兼容 Google contents 与 OpenAI messages
@@ -1088,7 +1279,7 @@ class DynamicProxyEndpoint:
                 # - OpenAI/Google：有结构化思考时附加<think>
                 # - Anthropic：若有工具调用，追加标记以便 utils.format_to_sharegpt 抽取为 function_call
                 if auth_type in ("openai", "google") and complete_reasoning:
-                    formatted_response = f"<think>\n{complete_reasoning}\n</think>\n\n{complete_response}"
+                    formatted_response = _with_think(complete_reasoning, complete_response)
                 else:
                     formatted_response = complete_response
                 if auth_type == "anthropic" and len(anthropic_tool_calls) > 0:
@@ -1099,14 +1290,14 @@ class DynamicProxyEndpoint:
                     append_text = f"[ANTHROPIC_TOOL_CALLS: {marker}]"
                     if save_due_to_tool and not complete_response:
                         # fc-only：不写任何 assistant 文本；直接把工具调用转为 function_call 消息；response 留空
-                        if not isinstance(messages, list):
-                            messages = []
+                        # messages 引用的是请求体中的列表，追加前先浅拷贝，避免改写 request_data
+                        messages = list(messages) if isinstance(messages, list) else []
                         for tc in anthropic_tool_calls:
                             fn = tc.get("function", {}) if isinstance(tc, dict) else {}
                             name = fn.get("name", "unknown_tool")
                             args_val = fn.get("arguments", "{}")
                             try:
-                                args_obj = json.loads(args_val) if isinstance(args_val, str) else args_val
+                                args_obj = orjson.loads(args_val) if isinstance(args_val, str) else args_val
                             except Exception:
                                 args_obj = args_val
                             messages.append({
@@ -1119,8 +1310,9 @@ class DynamicProxyEndpoint:
                         formatted_response = (formatted_response or "") + "\n" + append_text
                 
                 # 调试：打印最终保存的内容
-                await self.async_logger.debug(f"🔍 调试 - 流式响应最终内容长度: {len(formatted_response)}")
-                await self.async_logger.debug(f"🔍 调试 - 流式响应前100字符: {formatted_response[:100]}...")
+                if self._debug:
+                    await self.async_logger.debug(f"🔍 调试 - 流式响应最终内容长度: {len(formatted_response)}")
+                    await self.async_logger.debug(f"🔍 调试 - 流式响应前100字符: {formatted_response[:100]}...")
                 
                 await self._queue_conversation(response_id, model, {
                     'request': request_data,
@@ -1133,17 +1325,17 @@ class DynamicProxyEndpoint:
     
     async def _handle_non_stream_response(self, resp: aiohttp.ClientResponse,
                                         auth_type: str, model: str, request_data: Dict[str, Any]) -> web.Response:
-        """处理非流式响应"""
-        response_text = await resp.text()
+        """处理非流式响应（原始字节直接解析并原样返回，不做整体解码）"""
+        response_body = await resp.read()
         
         # 记录上游响应状态
         if resp.status >= 400:
             await self.async_logger.warning(
-                f"⚠️ 上游服务器返回错误: {resp.status} - {response_text[:200]}..."
+                f"⚠️ 上游服务器返回错误: {resp.status} - {response_body[:200].decode('utf-8', errors='replace')}..."
             )
         
         try:
-            response_json = json.loads(response_text)
+            response_json = orjson.loads(response_body)
             
             # 解析响应内容
             complete_response = ""
@@ -1165,11 +1357,12 @@ class DynamicProxyEndpoint:
                 messages = self._extract_messages_for_archive(auth_type, request_data)
                 
                 # 调试：打印转换后的消息
-                await self.async_logger.debug(f"🔍 调试 - 转换后的消息格式: {json.dumps(messages, ensure_ascii=False, indent=2)}")
+                if self._debug:
+                    await self.async_logger.debug(f"🔍 调试 - 转换后的消息格式: {_dumps_for_log(messages)}")
                 
                 # 对非流式：仅在 OpenAI 且存在结构化 reasoning_content 时，把思考并入 response
                 combined_response = (
-                    f"<think>\n{reasoning}\n</think>\n\n{complete_response}"
+                    _with_think(reasoning, complete_response)
                     if (auth_type in ["openai", "google"] and reasoning) else complete_response
                 )
                 
@@ -1180,7 +1373,8 @@ class DynamicProxyEndpoint:
                     'reasoning': reasoning,
                     'messages': messages
                 }
-                await self.async_logger.debug(f"🔍 调试 - 准备保存的对话数据: {json.dumps(conversation_to_save, ensure_ascii=False, indent=2)}")
+                if self._debug:
+                    await self.async_logger.debug(f"🔍 调试 - 准备保存的对话数据: {_dumps_for_log(conversation_to_save)}")
                 
                 # 确保传递完整的请求消息
                 await self._queue_conversation(response_id, model, conversation_to_save)
@@ -1190,22 +1384,22 @@ class DynamicProxyEndpoint:
         
         return web.Response(
             status=resp.status,
-            text=response_text,
-            headers={'Content-Type': 'application/json'}
+            body=response_body,
+            headers={'Content-Type': 'application/json; charset=utf-8'}
         )
     
-    def _parse_openai_stream_chunk(self, line_str: str, complete_response: str, response_id: Optional[str]):
-        """解析OpenAI流式响应块"""
-        complete_reasoning = ""
+    def _parse_openai_stream_chunk(self, line_b: bytes, response_chunks: list, reasoning_chunks: list,
+                                   response_id: Optional[str]) -> Optional[str]:
+        """解析OpenAI流式响应块（line_b 为去除首尾空白的原始字节行），文本与思考分别追加到两个列表，返回 response_id"""
         
-        if line_str.startswith("data: "):
-            if line_str.strip() == "data: [DONE]":
-                return complete_response, response_id, complete_reasoning
+        if line_b.startswith(b"data: "):
+            if line_b == b"data: [DONE]":
+                return response_id
             
             try:
-                json_data = line_str[6:].strip()
+                json_data = line_b[6:].strip()
                 if json_data:
-                    json_chunk = json.loads(json_data)
+                    json_chunk = orjson.loads(json_data)
                     if "id" in json_chunk and not response_id:
                         response_id = json_chunk["id"]
                     if "choices" in json_chunk and json_chunk["choices"]:
@@ -1214,51 +1408,27 @@ class DynamicProxyEndpoint:
                         # 兼容多种结构的 reasoning_content，仅用于存档累加
                         if rc is not None:
                             try:
-                                if isinstance(rc, str):
-                                    complete_reasoning += rc
-                                elif isinstance(rc, dict):
-                                    # 常见字段尝试展开
-                                    for k in ["text", "content", "message"]:
-                                        v = rc.get(k)
-                                        if isinstance(v, str):
-                                            complete_reasoning += v
-                                        elif isinstance(v, list):
-                                            complete_reasoning += "".join(
-                                                x.get("text", "") if isinstance(x, dict) else str(x) for x in v
-                                            )
-                                    # parts 结构
-                                    parts = rc.get("parts")
-                                    if isinstance(parts, list):
-                                        complete_reasoning += "".join(
-                                            x.get("text", "") if isinstance(x, dict) else str(x) for x in parts
-                                        )
-                                elif isinstance(rc, list):
-                                    complete_reasoning += "".join(
-                                        x.get("text", "") if isinstance(x, dict) else str(x) for x in rc
-                                    )
-                                else:
-                                    # 兜底序列化
-                                    complete_reasoning += str(rc)
+                                reasoning_chunks.append(_flatten_reasoning(rc))
                             except Exception:
                                 pass
                         content = delta.get("content")
-                        if content is not None:
-                            complete_response += content
+                        if isinstance(content, str):
+                            response_chunks.append(content)
             except json.JSONDecodeError:
                 pass
             except Exception:
                 pass
         
-        return complete_response, response_id, complete_reasoning
+        return response_id
     
-    def _parse_anthropic_stream_chunk(self, line_str: str, complete_response: str, response_id: Optional[str]):
-        """解析Anthropic流式响应块"""
-        if line_str.startswith("data: "):
-            if line_str.strip() == "data: [DONE]":
-                return complete_response, response_id, ""
+    def _parse_anthropic_stream_chunk(self, line_b: bytes, response_chunks: list, response_id: Optional[str]) -> Optional[str]:
+        """解析Anthropic流式响应块（line_b 为去除首尾空白的原始字节行），文本追加到列表，返回 response_id"""
+        if line_b.startswith(b"data: "):
+            if line_b == b"data: [DONE]":
+                return response_id
             
             try:
-                json_chunk = json.loads(line_str[6:])
+                json_chunk = orjson.loads(line_b[6:])
                 
                 if json_chunk.get("type") == "message_start" and "message" in json_chunk:
                     message = json_chunk["message"]
@@ -1269,12 +1439,13 @@ class DynamicProxyEndpoint:
                     delta = json_chunk.get("delta", {})
                     if delta.get("type") == "text_delta":
                         text = delta.get("text", "")
-                        complete_response += text
+                        if isinstance(text, str):
+                            response_chunks.append(text)
                         
             except json.JSONDecodeError:
                 pass
         
-        return complete_response, response_id, ""
+        return response_id
     
     def _parse_openai_final_response(self, response_json: Dict[str, Any]) -> str:
         """解析OpenAI最终响应内容"""
@@ -1285,27 +1456,12 @@ class DynamicProxyEndpoint:
                 # 兼容对象/数组形式的 reasoning_content
                 if not isinstance(rc, str) and rc:
                     try:
-                        if isinstance(rc, dict):
-                            buf = []
-                            for k in ["text", "content", "message"]:
-                                v = rc.get(k)
-                                if isinstance(v, str):
-                                    buf.append(v)
-                                elif isinstance(v, list):
-                                    buf.extend(x.get("text", "") if isinstance(x, dict) else str(x) for x in v)
-                            parts = rc.get("parts")
-                            if isinstance(parts, list):
-                                buf.extend(x.get("text", "") if isinstance(x, dict) else str(x) for x in parts)
-                            rc = "".join(buf).strip()
-                        elif isinstance(rc, list):
-                            rc = "".join(x.get("text", "") if isinstance(x, dict) else str(x) for x in rc).strip()
-                        else:
-                            rc = str(rc)
+                        rc = _flatten_reasoning(rc).strip()
                     except Exception:
                         rc = ""
                 reasoning_content = rc if isinstance(rc, str) else ""
                 response_content = choice["message"].get("content", "")
-                return f"<think>\n{reasoning_content}\n</think>\n\n{response_content}" if reasoning_content else response_content
+                return _with_think(reasoning_content, response_content) if reasoning_content else response_content
         return ""
     
     async def _parse_google_final_response(self, response_json: Dict[str, Any]) -> tuple[str, str]:
@@ -1314,18 +1470,20 @@ class DynamicProxyEndpoint:
         reasoning = ""
         
         # 调试：打印完整响应结构
-        import json
-        await self.async_logger.debug(f"🔍 调试 - Google API完整响应: {json.dumps(response_json, ensure_ascii=False, indent=2)}")
+        if self._debug:
+            await self.async_logger.debug(f"🔍 调试 - Google API完整响应: {_dumps_for_log(response_json)}")
         
         # 检查是否有错误状态
         finish_reason = None
         if "candidates" in response_json and response_json["candidates"]:
             candidate = response_json["candidates"][0]
-            await self.async_logger.debug(f"🔍 调试 - candidate结构: {json.dumps(candidate, ensure_ascii=False, indent=2)}")
+            if self._debug:
+                await self.async_logger.debug(f"🔍 调试 - candidate结构: {_dumps_for_log(candidate)}")
             
             # 获取finishReason
             finish_reason = candidate.get("finishReason")
-            await self.async_logger.debug(f"🔍 调试 - finishReason: {finish_reason}")
+            if self._debug:
+                await self.async_logger.debug(f"🔍 调试 - finishReason: {finish_reason}")
             
             if finish_reason and finish_reason != "STOP":
                 # 处理错误状态
@@ -1343,7 +1501,8 @@ class DynamicProxyEndpoint:
             
             if isinstance(candidate, dict) and "content" in candidate:
                 content = candidate["content"]
-                await self.async_logger.debug(f"🔍 调试 - content结构: {json.dumps(content, ensure_ascii=False, indent=2)}")
+                if self._debug:
+                    await self.async_logger.debug(f"🔍 调试 - content结构: {_dumps_for_log(content)}")
                 
                 # 检查content是否有parts字段
                 if isinstance(content, dict) and "parts" in content:
@@ -1353,24 +1512,26 @@ class DynamicProxyEndpoint:
                         text_parts = []
                         thought_parts = []
                         
+                        # JSON 解析结果均为精确的 dict/str，用 type() 判断即可
                         for part in parts:
-                            if isinstance(part, dict):
-                                is_thought_part = False
-                                # 优先解析结构化思考：part.thinking.thought
-                                if "thinking" in part and isinstance(part.get("thinking"), dict):
-                                    t = part["thinking"].get("thought")
-                                    if isinstance(t, str) and t:
-                                        thought_parts.append(t)
-                                        is_thought_part = True
-                                # 兼容旧结构：part.thought == True 且 text 属于思考
-                                elif "thought" in part and isinstance(part.get("thought"), bool) and part.get("thought") is True:
-                                    t = part.get("text", "")
-                                    if isinstance(t, str) and t:
-                                        thought_parts.append(t)
-                                        is_thought_part = True
-                                # 普通文本内容（面向用户可见的回答），仅在非思考片段时纳入
-                                if (not is_thought_part) and "text" in part and isinstance(part.get("text"), str):
-                                    text_parts.append(part["text"])
+                            if type(part) is not dict:
+                                continue
+                            text = part.get("text")
+                            # 优先解析结构化思考：part.thinking.thought
+                            thinking = part.get("thinking")
+                            if type(thinking) is dict:
+                                t = thinking.get("thought")
+                                if t and type(t) is str:
+                                    thought_parts.append(t)
+                                    continue
+                            # 兼容旧结构：part.thought == True 且 text 属于思考
+                            elif part.get("thought") is True:
+                                if text and type(text) is str:
+                                    thought_parts.append(text)
+                                    continue
+                            # 普通文本内容（面向用户可见的回答），仅在非思考片段时纳入
+                            if type(text) is str:
+                                text_parts.append(text)
                         
                         # 合并响应内容
                         response_text = "\n".join(text_parts)
@@ -1390,45 +1551,42 @@ class DynamicProxyEndpoint:
                     
                     # 如果content只有role字段，可能响应内容为空
                     if not response_text and "role" in content:
-                        await self.async_logger.debug(f"🔍 调试 - content只有role字段，响应内容为空")
+                        if self._debug:
+                            await self.async_logger.debug(f"🔍 调试 - content只有role字段，响应内容为空")
         
         # 调试：打印提取结果
-        await self.async_logger.debug(f"🔍 调试 - 提取的响应内容长度: {len(response_text)}")
-        await self.async_logger.debug(f"🔍 调试 - 提取的思考过程长度: {len(reasoning)}")
+        if self._debug:
+            await self.async_logger.debug(f"🔍 调试 - 提取的响应内容长度: {len(response_text)}")
+            await self.async_logger.debug(f"🔍 调试 - 提取的思考过程长度: {len(reasoning)}")
         
         return response_text, reasoning
     
-    async def _parse_google_stream_chunk(self, line_str: str, complete_response: str, response_id: Optional[str]):
-        """解析Google API流式响应块；兼容 OpenAI 风格的 choices.delta"""
-        complete_reasoning = ""
-        await self.async_logger.debug(f"🔍 调试 - Google流式原始数据: {repr(line_str[:100])}")
+    def _parse_google_stream_chunk(self, line_b: bytes, response_chunks: list, reasoning_chunks: list,
+                                   response_id: Optional[str]) -> Optional[str]:
+        """解析Google API流式响应块（line_b 为去除首尾空白的原始字节行）；兼容 OpenAI 风格的 choices.delta。
+        文本与思考分别追加到两个列表，返回 response_id。
+        同步函数：每个 SSE 行都会调用，日志直接走 AsyncLogger 底层的同步 logger（入队即返回），不再创建协程"""
+        if self._debug:
+            self.async_logger.logger.debug(f"🔍 调试 - Google流式原始数据: {repr(line_b[:100].decode('utf-8', errors='ignore'))}")
         
         # 统一提取 JSON 载荷
-        payload = line_str.strip()
-        if payload.startswith("data: "):
-            if payload.strip() == "data: [DONE]":
-                return complete_response, response_id, complete_reasoning
+        payload = line_b
+        if payload.startswith(b"data: "):
+            if payload == b"data: [DONE]":
+                return response_id
             payload = payload[6:].strip()
         if not payload:
-            return complete_response, response_id, complete_reasoning
+            return response_id
+        
+        # SSE 每个事件都是完整 JSON 对象；其余片段直接跳过
+        if not (payload.startswith(b"{") and payload.endswith(b"}")):
+            if self._debug:
+                self.async_logger.logger.debug(f"🔍 调试 - 跳过非完整JSON片段: {repr(payload[:100].decode('utf-8', errors='ignore'))}")
+            return response_id
         
         try:
-            if not (payload.startswith("{") and payload.endswith("}")):
-                # 非完整 JSON 的简易提取（Google 片段）
-                if '"text":' in payload and '"thought": true' not in payload and '"thinking"' not in payload:
-                    import re as _re
-                    m = _re.search(r'"text":\s*"([^"]*)"', payload)
-                    if m:
-                        complete_response += m.group(1)
-                if '"responseId":' in payload and not response_id:
-                    import re as _re
-                    m = _re.search(r'"responseId":\s*"([^"]*)"', payload)
-                    if m:
-                        response_id = m.group(1)
-                return complete_response, response_id, complete_reasoning
-            
             # 解析完整 JSON
-            obj = json.loads(payload)
+            obj = orjson.loads(payload)
             # 兼容 OpenAI 风格 chunk：choices.delta
             if isinstance(obj, dict) and "choices" in obj and obj.get("choices"):
                 ch0 = obj["choices"][0]
@@ -1439,28 +1597,13 @@ class DynamicProxyEndpoint:
                     rc = delta.get("reasoning_content")
                     if rc is not None:
                         try:
-                            if isinstance(rc, str):
-                                complete_reasoning += rc
-                            elif isinstance(rc, dict):
-                                for k in ("text", "content", "message"):
-                                    v = rc.get(k)
-                                    if isinstance(v, str):
-                                        complete_reasoning += v
-                                    elif isinstance(v, list):
-                                        complete_reasoning += "".join(x.get("text", "") if isinstance(x, dict) else str(x) for x in v)
-                                parts = rc.get("parts")
-                                if isinstance(parts, list):
-                                    complete_reasoning += "".join(x.get("text", "") if isinstance(x, dict) else str(x) for x in parts)
-                            elif isinstance(rc, list):
-                                complete_reasoning += "".join(x.get("text", "") if isinstance(x, dict) else str(x) for x in rc)
-                            else:
-                                complete_reasoning += str(rc)
+                            reasoning_chunks.append(_flatten_reasoning(rc))
                         except Exception:
                             pass
                     content = delta.get("content")
                     if isinstance(content, str):
-                        complete_response += content
-                return complete_response, response_id, complete_reasoning
+                        response_chunks.append(content)
+                return response_id
             
             # Google candidates 解析
             if "responseId" in obj and not response_id:
@@ -1471,38 +1614,36 @@ class DynamicProxyEndpoint:
                 parts = cont.get("parts", [])
                 if isinstance(parts, list):
                     for part in parts:
-                        if not isinstance(part, dict):
+                        if type(part) is not dict:
                             continue
                         # 思考
-                        if "thinking" in part and isinstance(part.get("thinking"), dict):
-                            t = part["thinking"].get("thought")
-                            if isinstance(t, str) and t:
-                                complete_reasoning += t
-                        elif part.get("thought") is True:
-                            t = part.get("text")
-                            if isinstance(t, str) and t:
-                                complete_reasoning += t
+                        thinking = part.get("thinking")
+                        if type(thinking) is dict:
+                            t = thinking.get("thought")
+                            if t and type(t) is str:
+                                reasoning_chunks.append(t)
+                            continue
+                        text = part.get("text")
+                        if part.get("thought") is True:
+                            if text and type(text) is str:
+                                reasoning_chunks.append(text)
                         # 可见文本
-                        elif "text" in part and isinstance(part.get("text"), str):
-                            complete_response += part["text"]
+                        elif type(text) is str:
+                            response_chunks.append(text)
         except Exception as e:
-            await self.async_logger.error(f"Google流式解析错误: {e}")
-            await self.async_logger.error(f"错误详情: {traceback.format_exc()}")
+            self.async_logger.logger.error("Google流式解析错误: %s", e, exc_info=True)
         
-        return complete_response, response_id, complete_reasoning
+        return response_id
     
     def _parse_anthropic_final_response(self, response_json: Dict[str, Any]) -> str:
         """解析Anthropic最终响应内容"""
         content_list = response_json.get("content", [])
-        response_content = ""
-        
-        if isinstance(content_list, list) and content_list:
-            for content_item in content_list:
-                if isinstance(content_item, dict):
-                    if content_item.get("type") == "text":
-                        response_content += content_item.get("text", "")
-        
-        return response_content
+        if not isinstance(content_list, list):
+            return ""
+        return "".join(
+            ci.get("text", "") for ci in content_list
+            if isinstance(ci, dict) and ci.get("type") == "text"
+        )
     
 
     
@@ -1511,120 +1652,77 @@ class DynamicProxyEndpoint:
     async def _queue_conversation(self, id: str, model: str, conversation: dict):
         """将对话加入队列等待批量保存"""
         try:
-            conversation_data = {
-                'id': id,
-                'model': model,
-                'conversation': conversation,
-                'timestamp': time.time()
-            }
-            await self.conversation_queue.put(conversation_data)
+            await self.conversation_queue.put(QueuedConversation(id, model, conversation, time.time()))
         except Exception as e:
             await self.async_logger.error(f"加入对话队列失败: {e}")
     
     async def _batch_save_conversations(self):
-        """批量保存对话"""
-        batch = []
-        last_save_time = time.time()
-        
+        """批量保存对话：阻塞等待第一条，随后在 batch_timeout 截止前凑够 batch_size 条即落库。
+        队列中已有的数据用 get_nowait 直接取出，只有队列为空时才挂起等待"""
+        loop = asyncio.get_running_loop()
+        queue = self.conversation_queue
         while True:
+            batch = []
             try:
-                # 等待新的对话数据或超时
-                try:
-                    conversation_data = await asyncio.wait_for(
-                        self.conversation_queue.get(), 
-                        timeout=self.batch_timeout
-                    )
-                    batch.append(conversation_data)
-                except asyncio.TimeoutError:
-                    pass
-                
-                current_time = time.time()
-                
-                # 检查是否需要保存批次
-                should_save = (
-                    len(batch) >= self.batch_size or
-                    (batch and current_time - last_save_time >= self.batch_timeout)
-                )
-                
-                if should_save and batch:
+                batch.append(await queue.get())
+                deadline = loop.time() + self.batch_timeout
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(queue.get_nowait())
+                        continue
+                    except asyncio.QueueEmpty:
+                        pass
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+                await self._save_batch(batch)
+            except asyncio.CancelledError:
+                # 关闭时保存已取出但尚未落库的对话，避免丢失
+                if batch:
                     await self._save_batch(batch)
-                    batch = []
-                    last_save_time = current_time
-                    
+                raise
             except Exception as e:
                 await self.async_logger.error(f"批量保存对话时发生错误: {e}")
                 await asyncio.sleep(1)
     
     async def _save_batch(self, batch):
-        """保存一批对话（复用单个 DB 连接提升性能）"""
-        db_conn = None
+        """保存一批对话（复用长连接 + 单事务批量写入）"""
         try:
-            db_conn = await get_db_connection()
-            for conversation_data in batch:
-                # 检查数据结构
-                if not isinstance(conversation_data, dict):
-                    await self.async_logger.error(f"无效的对话数据类型: {type(conversation_data)}")
-                    continue
-                
-                if 'conversation' not in conversation_data:
-                    await self.async_logger.error(f"对话数据缺少conversation字段: {conversation_data}")
-                    continue
-                
-                conversation = conversation_data['conversation']
-                if not isinstance(conversation, dict):
-                    await self.async_logger.error(f"conversation字段类型错误: {type(conversation)}")
-                    continue
-                
-                # 格式化为ShareGPT格式
-                # 优先使用conversation中的messages，如果没有则使用request中的messages
-                messages = conversation.get('messages', conversation.get('request', {}).get('messages', []))
-                # 入库轻量纠正：修复“连续两个 user 且第二条像 AI 回答”
-                norm_changed = False
-                try:
-                    messages, norm_changed = normalize_roles(messages)
-                except Exception:
-                    norm_changed = False
-                if norm_changed:
-                    # 审计标记 + 保留原始请求
-                    try:
-                        flags = conversation.setdefault('flags', [])
-                        if 'normalized_roles' not in flags:
-                            flags.append('normalized_roles')
-                        conversation.setdefault('request_raw', conversation.get('request', {}))
-                    except Exception:
-                        pass
-                # 调试：打印格式化前的数据
-                await self.async_logger.debug(f"🔍 调试 - 格式化前的消息: {json.dumps(messages, ensure_ascii=False, indent=2)}")
-                await self.async_logger.debug(f"🔍 调试 - 响应内容: {conversation.get('response', '')}")
-                
-                sharegpt_data = format_to_sharegpt(
-                    conversation_data.get('model', 'unknown'),
-                    messages,
-                    conversation.get('response', ''),
-                    conversation.get('request', {})
-                )
-                
-                # 调试：打印格式化后的数据
-                await self.async_logger.debug(f"🔍 调试 - 格式化后的ShareGPT数据: {json.dumps(sharegpt_data, ensure_ascii=False, indent=2)}")
-                
-                # 保存到数据库（复用连接）
-                await save_conversation_async(
-                    db_conn,
-                    conversation_data.get('id', str(uuid.uuid4())),
-                    conversation_data.get('model', 'unknown'),
-                    sharegpt_data
-                )
+            # 格式化与 JSON 编码都是纯 CPU 工作，放到线程池执行，避免阻塞事件循环
+            rows, details, errors = await asyncio.get_running_loop().run_in_executor(None, _serialize_batch, batch)
+            for err in errors:
+                await self.async_logger.error(err)
+            if self._debug:
+                for messages, response, sharegpt_data in details:
+                    await self.async_logger.debug(f"🔍 调试 - 格式化前的消息: {_dumps_for_log(messages)}")
+                    await self.async_logger.debug(f"🔍 调试 - 响应内容: {response}")
+                    await self.async_logger.debug(f"🔍 调试 - 格式化后的ShareGPT数据: {_dumps_for_log(sharegpt_data)}")
             
-            await self.async_logger.info(f"✅ 成功保存 {len(batch)} 条对话")
+            if not rows:
+                return
+            # 整批一次事务写入，只提交一次
+            if self._db_conn is None:
+                self._db_conn = await get_db_connection()
+            saved = await save_conversations_batch_async(self._db_conn, rows)
+            await self.async_logger.info(f"✅ 成功保存 {saved} 条对话")
             
         except Exception as e:
-            await self.async_logger.error(f"保存对话批次失败: {e}\n{traceback.format_exc()}")
-        finally:
-            if db_conn is not None:
-                try:
-                    await db_conn.close()
-                except Exception:
-                    pass
+            await self.async_logger.error("保存对话批次失败: %s", e, exc_info=True)
+            # 连接可能已失效，下一批重新建立
+            await self._close_db_conn()
+    
+    async def _close_db_conn(self):
+        """关闭批量保存使用的长连接"""
+        db_conn, self._db_conn = self._db_conn, None
+        if db_conn is not None:
+            try:
+                await db_conn.close()
+            except Exception:
+                pass
     
     async def handle_health_check(self, request: web.Request) -> web.Response:
         """健康检查端点"""
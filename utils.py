@@ -1,8 +1,11 @@
 import json
+import orjson
 import logging
 import asyncio
 import aiosqlite
+import sqlite3
 import traceback
+import zlib
 from logging.handlers import QueueHandler, QueueListener
 from queue import Queue
 from typing import Optional
@@ -47,21 +50,34 @@ class AsyncLogger:
             respect_handler_level=True
         )
         self.listener.start()
+        self._listener_started = True
+    
+    def close(self):
+        """停止队列监听器，写出队列中剩余的日志（可重复调用）"""
+        # 启动状态由自身记录；__init__ 中途失败时 __del__ 也会调用到这里
+        if getattr(self, '_listener_started', False):
+            self._listener_started = False
+            self.listener.stop()
     
     def __del__(self):
-        self.listener.stop()
+        self.close()
+    
+    def isEnabledFor(self, level: int) -> bool:
+        """供调用方在构造昂贵的日志内容前判断级别"""
+        return self.logger.isEnabledFor(level)
     
-    async def debug(self, msg: str):
-        self.logger.debug(msg)
+    # 参数与 logging.Logger 一致（支持 %s 参数与 exc_info），仅在需要输出时才格式化
+    async def debug(self, msg: str, *args, **kwargs):
+        self.logger.debug(msg, *args, **kwargs)
     
-    async def info(self, msg: str):
-        self.logger.info(msg)
+    async def info(self, msg: str, *args, **kwargs):
+        self.logger.info(msg, *args, **kwargs)
     
-    async def warning(self, msg: str):
-        self.logger.warning(msg)
+    async def warning(self, msg: str, *args, **kwargs):
+        self.logger.warning(msg, *args, **kwargs)
     
-    async def error(self, msg: str):
-        self.logger.error(msg)
+    async def error(self, msg: str, *args, **kwargs):
+        self.logger.error(msg, *args, **kwargs)
 
 # 全局异步日志实例
 _async_logger: Optional[AsyncLogger] = None
@@ -73,7 +89,7 @@ def init_async_logger(name: str, log_file: str, level=logging.DEBUG) -> AsyncLog
     # 如果已存在实例，先尝试清理资源
     if _async_logger is not None:
         try:
-            _async_logger.listener.stop()
+            _async_logger.close()
         except Exception as e:
             logger.warning(f"停止现有日志监听器时出错: {e}")
     
@@ -89,6 +105,17 @@ def init_async_logger(name: str, log_file: str, level=logging.DEBUG) -> AsyncLog
     
     return _async_logger
 
+def queue_logger_handlers(target: logging.Logger) -> QueueListener:
+    """将日志器现有的处理器移到后台监听线程，调用方只做入队，不在事件循环里同步写输出"""
+    handlers = target.handlers[:]
+    log_queue = Queue()
+    for handler in handlers:
+        target.removeHandler(handler)
+    target.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
 # 获取异步日志实例
 def get_async_logger() -> Optional[AsyncLogger]:
     """获取全局异步日志实例"""
@@ -97,6 +124,14 @@ def get_async_logger() -> Optional[AsyncLogger]:
 # 数据库路径全局变量
 _db_path: str = "interactions.db"
 
+# 每个连接都要设置的 PRAGMA；journal_mode=WAL 持久化在库文件中，初始化时设置一次即可
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",      # 64MB 页缓存
+    "PRAGMA mmap_size=268435456",    # 256MB 内存映射
+)
+
 # 初始化数据库路径
 async def init_db_path(db_path: str = "interactions.db") -> str:
     """初始化数据库路径"""
@@ -106,6 +141,8 @@ async def init_db_path(db_path: str = "interactions.db") -> str:
     conn = None
     try:
         conn = await aiosqlite.connect(db_path)
+        # WAL：Web 管理界面读取时不阻塞代理写入
+        await conn.execute("PRAGMA journal_mode=WAL")
         await conn.execute(
             """CREATE TABLE IF NOT EXISTS interactions (
                 id TEXT PRIMARY KEY,
@@ -114,7 +151,13 @@ async def init_db_path(db_path: str = "interactions.db") -> str:
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
             )"""
         )
+        # Web 管理界面与导出脚本均按时间排序
+        await conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_interactions_timestamp ON interactions(timestamp)"
+        )
         await conn.commit()
+        # conversation 列存储格式迁移（一次性，见 migrate_conversation_storage）
+        await asyncio.to_thread(migrate_conversation_storage, db_path)
         logger.info("✅ 数据库初始化完成")
     except Exception as e:
         logger.error(f"初始化数据库时出错: {e}\n{traceback.format_exc()}")
@@ -130,6 +173,8 @@ async def get_db_connection() -> aiosqlite.Connection:
     global _db_path
     try:
         conn = await aiosqlite.connect(_db_path)
+        for pragma in _CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
         return conn
     except Exception as e:
         logger.error(f"创建数据库连接时出错: {e}\n{traceback.format_exc()}")
@@ -403,35 +448,139 @@ def format_to_sharegpt(model: str, messages: list, response: str, request_data:
         "tools": json.dumps(tools, ensure_ascii=False) if tools else "[]"  # 确保tools是JSON字符串格式
     }
 
+# conversations[].from 的位编码（gpt/assistant 同码），Web 管理界面（app.py）与导出脚本（process_conversations.py）共用
+FROM_FUNCTION_CALL = 1
+FROM_OBSERVATION = 2
+FROM_GPT = 4
+FROM_HUMAN = 8
+FROM_TOOL = FROM_FUNCTION_CALL | FROM_OBSERVATION
+FROM_CODES = {
+    "function_call": FROM_FUNCTION_CALL,
+    "observation": FROM_OBSERVATION,
+    "gpt": FROM_GPT,
+    "assistant": FROM_GPT,
+    "human": FROM_HUMAN,
+}
+
+def mask_function_call_only(mask: int) -> bool:
+    """
+    按角色位掩码判断“仅工具调用”：存在 function_call，且不存在 gpt/assistant 文本项。
+    这是 Web 管理界面的标记口径；导出时的 --only-function-call-only 按“最后一轮”判断（见 process_conversations.validate_sharegpt）。
+    """
+    return mask & (FROM_FUNCTION_CALL | FROM_GPT) == FROM_FUNCTION_CALL
+
+_INSERT_CONVERSATION_SQL = """INSERT INTO interactions (id, model, conversation)
+                VALUES (?, ?, ?)"""
+
+def encode_conversation(conversation: dict) -> str:
+    """
+    序列化对话数据，用于写入 conversation 列（TEXT，明文 JSON；以 str 绑定，SQLite 按文本存储）。
+    orjson 不支持的内容（超出 64 位的整数、孤立代理项等）回退到标准库 json；两者都无法序列化时抛出异常。
+    """
+    try:
+        return orjson.dumps(conversation, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except orjson.JSONEncodeError:
+        # 保持 ASCII 转义：孤立代理项无法按 UTF-8 写入 TEXT 列，转义后仍是合法 JSON
+        return json.dumps(conversation)
+
+# conversation 列存储格式版本，记录在 PRAGMA user_version 中：
+# 0 = 可能含早期版本写入的 zlib 压缩 BLOB；1 = 全部为明文 JSON 文本
+CONVERSATION_STORAGE_VERSION = 1
+_CONVERSATION_TABLES = ("interactions", "confirmed_interactions")
+_MIGRATE_BATCH_ROWS = 1000
+
+def migrate_conversation_storage(db_path: str) -> int:
+    """
+    一次性迁移：把早期版本写入 conversation 列的 zlib 压缩 BLOB 解压回明文 JSON 文本。
+    完成后写入 PRAGMA user_version，之后的调用只读取版本号即返回。返回转换的行数。
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= CONVERSATION_STORAGE_VERSION:
+            return 0
+        tables = {r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        converted = 0
+        with conn:
+            for table in _CONVERSATION_TABLES:
+                if table not in tables:
+                    continue
+                select_sql = (f"SELECT rowid, conversation FROM {table} "
+                              f"WHERE typeof(conversation) = 'blob' LIMIT {_MIGRATE_BATCH_ROWS}")
+                update_sql = f"UPDATE {table} SET conversation = ? WHERE rowid = ?"
+                # 已转换的行不再满足 typeof = 'blob'，逐批取到为空即完成
+                while True:
+                    batch = conn.execute(select_sql).fetchall()
+                    if not batch:
+                        break
+                    updates = []
+                    for rowid, blob in batch:
+                        try:
+                            text = zlib.decompress(blob).decode("utf-8")
+                        except (zlib.error, UnicodeDecodeError):
+                            # 非压缩或损坏的二进制内容：按 UTF-8 尽量还原，交由读取端按无效记录处理
+                            text = bytes(blob).decode("utf-8", "replace")
+                        updates.append((text, rowid))
+                    conn.executemany(update_sql, updates)
+                    converted += len(updates)
+            conn.execute(f"PRAGMA user_version = {CONVERSATION_STORAGE_VERSION}")
+        if converted:
+            logger.info(f"✅ 已将 {converted} 条压缩对话转换为明文 JSON")
+        return converted
+    finally:
+        conn.close()
+
 def save_conversation(conn, response_id: str, model: str, conversation: dict):
     """保存对话数据到数据库（同步版本）"""
     try:
         with conn:
             c = conn.cursor()
             c.execute(
-                """INSERT INTO interactions (id, model, conversation)
-                VALUES (?, ?, ?)""",
-                (response_id, model, json.dumps(conversation, ensure_ascii=False))
+                _INSERT_CONVERSATION_SQL,
+                (response_id, model, encode_conversation(conversation))
             )
     except Exception as e:
         logger.error(f"保存对话数据时发生错误: {e}")
         raise
 
-async def save_conversation_async(conn, response_id: str, model: str, conversation: dict):
-    """保存对话数据到数据库（异步版本）"""
+async def save_conversations_batch_async(conn, rows: list) -> int:
+    """
+    批量保存对话数据：rows 为 (id, model, encode_conversation() 结果) 元组列表，单事务 executemany 写入。
+    遇到主键冲突等完整性错误时回滚并逐行重试，仅跳过出错的行；返回实际写入的条数
+    """
+    if not rows:
+        return 0
+    if not isinstance(conn, aiosqlite.Connection):
+        logger.error(f"错误的连接类型: {type(conn)}，需要aiosqlite.Connection")
+        raise TypeError(f"需要aiosqlite.Connection类型，但收到了{type(conn)}")
     try:
-        # 检查连接类型，确保使用正确的方法
-        if isinstance(conn, aiosqlite.Connection):
-            await conn.execute(
-                """INSERT INTO interactions (id, model, conversation)
-                VALUES (?, ?, ?)""",
-                (response_id, model, json.dumps(conversation, ensure_ascii=False))
-            )
-            await conn.commit()
-        else:
-            # 如果不是异步连接，记录错误
-            logger.error(f"错误的连接类型: {type(conn)}，需要aiosqlite.Connection")
-            raise TypeError(f"需要aiosqlite.Connection类型，但收到了{type(conn)}")
+        await conn.executemany(_INSERT_CONVERSATION_SQL, rows)
+        await conn.commit()
+        return len(rows)
+    except sqlite3.IntegrityError as e:
+        logger.warning(f"批量保存遇到完整性错误，改为逐行写入: {e}")
+        await conn.rollback()
+    except Exception as e:
+        logger.error(f"批量保存对话数据时发生错误: {e}")
+        try:
+            await conn.rollback()
+        except Exception:
+            pass
+        raise
+    # 逐行写入（仍在同一事务中提交一次），冲突的行单独记录后跳过
+    saved = 0
+    try:
+        for row in rows:
+            try:
+                await conn.execute(_INSERT_CONVERSATION_SQL, row)
+                saved += 1
+            except sqlite3.IntegrityError as e:
+                logger.error(f"保存对话 {row[0]} 失败，已跳过: {e}")
+        await conn.commit()
     except Exception as e:
-        logger.error(f"异步保存对话数据时发生错误: {e}")
-        raise
\ No newline at end of file
+        logger.error(f"逐行保存对话数据时发生错误: {e}")
+        try:
+            await conn.rollback()
+        except Exception:
+            pass
+        raise
+    return saved